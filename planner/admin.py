@@ -1,6 +1,6 @@
 from django.contrib import admin
 from .models import (Activity, PacedRun, Intervals, TimeTrial, CrossTrain, Profile,
-	CompletedAct)
+	CompletedAct, ActivityLog, WeeklyMileage, PlanSlot)
 admin.site.register(Activity)
 admin.site.register(PacedRun)
 admin.site.register(Intervals)
@@ -8,5 +8,8 @@ admin.site.register(TimeTrial)
 admin.site.register(CrossTrain)
 admin.site.register(Profile)
 admin.site.register(CompletedAct)
+admin.site.register(ActivityLog)
+admin.site.register(WeeklyMileage)
+admin.site.register(PlanSlot)
 
 # Register your models here.
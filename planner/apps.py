@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class PlannerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'planner'
+
+    def ready(self):
+        # Connects the receiver recording queries on new connections.
+        from . import instrumentation
@@ -0,0 +1,95 @@
+"""
+Per-user caching of data used to build the home page.
+
+The computed schedule (list of Day objects) is stored under a key made from
+the user, the plan start date and length (which with today's date give the 
+schedule position), today's date and a per-user version number.
+Views that change anything shown on the schedule bump the version, so old
+entries are never read again and simply expire. Works with any cache backend
+which can be shared between workers, set in settings.CACHES.
+
+The schedule and activity tables on the home page are also cached as
+rendered template fragments, the schedule under the schedule key and the
+activity table under the per-user 'activities' version, which views that
+change activities bump with invalidate_activities.
+"""
+from django.core.cache import cache
+from datetime import date
+import threading
+import time
+
+# How long computed schedules are kept for, in seconds.
+SCHEDULE_TIMEOUT = 60 * 60 * 24
+# How long rendered home page fragments are kept for, in seconds.
+FRAGMENT_TIMEOUT = 60 * 60 * 24
+
+# Hit / miss counts for schedule lookups in this process.
+_stats = {'hits':0,'misses':0}
+_stats_lock = threading.Lock()
+
+
+def _version_key(user_id,name):
+	return f'planner:version:{name}:{user_id}'
+
+
+def get_version(user_id,name='schedule'):
+	"""Return user's current version number for cached data called name."""
+	key = _version_key(user_id,name)
+	version = cache.get(key)
+	if version is None:
+		# Start from the current time, so a version lost from the cache is
+		# never reused.
+		cache.add(key,int(time.time() * 1000),None)
+		version = cache.get(key)
+	return version
+
+
+def bump_version(user_id,name='schedule'):
+	"""Invalidate all of user's cached data called name."""
+	key = _version_key(user_id,name)
+	try:
+		cache.incr(key)
+	except ValueError:
+		# Key missing, get_version will create a new one.
+		get_version(user_id,name)
+
+
+def invalidate_schedule(user_id):
+	"""Invalidate user's cached schedule."""
+	bump_version(user_id,'schedule')
+
+
+def invalidate_activities(user_id):
+	"""Invalidate user's cached activity table."""
+	bump_version(user_id,'activities')
+
+
+def schedule_key(profile):
+	"""Return cache key for profile's schedule as it should appear today."""
+	# Schedule position follows from plan start date, length and today.
+	version = get_version(profile.owner_id,'schedule')
+	return (
+		f'planner:schedule:{profile.owner_id}:{profile.plan_start_date}:'
+		f'{profile.plan_length}:{version}:{date.today().isoformat()}'
+		)
+
+
+def get_schedule(key):
+	"""Return cached schedule list for key, or None if not cached."""
+	schedule_list = cache.get(key)
+	with _stats_lock:
+		if schedule_list is None:
+			_stats['misses'] += 1
+		else:
+			_stats['hits'] += 1
+	return schedule_list
+
+
+def set_schedule(key,schedule_list):
+	cache.set(key,schedule_list,SCHEDULE_TIMEOUT)
+
+
+def schedule_cache_stats():
+	"""Return dict of schedule cache hits and misses in this process."""
+	with _stats_lock:
+		return dict(_stats)
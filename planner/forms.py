@@ -187,4 +187,14 @@ class Int_Goal_Form(forms.Form):
 	
 
 	
-			
\ No newline at end of file
+			
+
+
+class ImportForm(forms.Form):
+	"""
+	Form for uploading CSV / GPX files of completed activities.
+	"""
+	files = forms.FileField(
+		widget=forms.ClearableFileInput(attrs={'multiple':True}),
+		label='CSV or GPX files',
+		)
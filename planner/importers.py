@@ -0,0 +1,259 @@
+"""
+Import of completed activities logged with other tools.
+
+Files are parsed into entries, (date, name, distance) tuples with distance a
+Decimal in km or None, which save_entries writes as completed activities,
+history entries and weekly distance in batches. Supported files:
+
+CSV, one activity per row, with columns date (YYYY-MM-DD), name and optionally
+distance (km). Files exported from the history page can be imported as is.
+
+GPX, one activity per file. The date is taken from the first track point,
+the distance is the sum of the distances between track points.
+"""
+from django.db import transaction, IntegrityError
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from decimal import Decimal, InvalidOperation
+from pathlib import Path
+import csv
+import io
+import itertools
+import math
+import xml.etree.ElementTree as ElementTree
+
+from . import caching, views
+from .models import CompletedAct, ActivityLog, WeeklyMileage
+
+# Number of rows written per INSERT.
+IMPORT_BATCH_SIZE = 1000
+# Largest distance which fits in the completed activity distance column.
+MAX_DISTANCE = Decimal('999.99')
+# Mean radius of the earth in km, used for distances between GPS points.
+EARTH_RADIUS_KM = 6371.0088
+
+
+class ImportFileError(ValueError):
+	"""Raised for files which cannot be imported, with the reason."""
+
+
+def parse_csv(lines,filename='file'):
+	"""
+	Generator of entries from lines of a CSV file, read one row at a time.
+	Raises ImportFileError, giving the line, for rows which cannot be read.
+	"""
+	reader = csv.DictReader(lines)
+	for row in read_rows(reader,filename):
+		try:
+			# Completed activity exports call the date column date_done.
+			entry_date = date.fromisoformat(row.get('date') or row.get('date_done'))
+			distance = parse_distance(row.get('distance'))
+		except (TypeError,ValueError,InvalidOperation):
+			raise ImportFileError(
+				f'{filename} line {reader.line_num}: could not read date or distance')
+		name = (row.get('name') or 'Imported activity')[:40]
+		yield entry_date,name,distance
+
+
+def read_rows(reader,filename):
+	"""
+	Generator of rows from CSV reader, raising ImportFileError for files which
+	are not UTF-8 text or not CSV.
+	"""
+	rows = iter(reader)
+	while True:
+		try:
+			row = next(rows)
+		except StopIteration:
+			return
+		except UnicodeDecodeError:
+			raise ImportFileError(f'{filename}: not a UTF-8 text file')
+		except csv.Error:
+			raise ImportFileError(f'{filename} line {reader.line_num}: not a valid CSV row')
+		yield row
+
+
+def parse_distance(value):
+	"""Return distance string as Decimal km, or None if it is blank."""
+	if not value:
+		return None
+	distance = Decimal(value).quantize(Decimal('0.01'))
+	if not 0 <= distance <= MAX_DISTANCE:
+		raise ValueError(f'distance {value} out of range')
+	return distance or None
+
+
+def parse_gpx(file,filename='file'):
+	"""
+	Returns entry for a GPX file (opened in binary mode). The file is parsed
+	incrementally, discarding each track point after it has been measured.
+	"""
+	name = None
+	entry_date = None
+	distance = 0.0
+	previous = None
+	in_track = False
+	try:
+		for event,element in ElementTree.iterparse(file,events=('start','end')):
+			# Ignore XML namespace, GPX 1.0 and 1.1 use the same tag names.
+			tag = element.tag.rsplit('}',1)[-1]
+			if event == 'start':
+				if tag == 'trk':
+					in_track = True
+				continue
+			if tag == 'name' and in_track and name is None:
+				name = (element.text or '').strip()
+			elif tag == 'time' and in_track and entry_date is None:
+				entry_date = date.fromisoformat((element.text or '').strip()[:10])
+			elif tag == 'trkpt':
+				point = (float(element.get('lat')),float(element.get('lon')))
+				if previous:
+					distance += haversine(previous,point)
+				previous = point
+				element.clear()
+			elif tag == 'trkseg':
+				# No distance is covered between segments.
+				previous = None
+				element.clear()
+	except (ElementTree.ParseError,TypeError,ValueError):
+		raise ImportFileError(f'{filename}: not a valid GPX file')
+	if entry_date is None:
+		raise ImportFileError(f'{filename}: no timed track points')
+	try:
+		distance = parse_distance(str(round(distance,2)))
+	except ValueError:
+		raise ImportFileError(f'{filename}: track too long')
+	return entry_date,(name or Path(filename).stem)[:40],distance
+
+
+def haversine(start,end):
+	"""Return great circle distance in km between two (lat, lon) points."""
+	lat1,lon1 = map(math.radians,start)
+	lat2,lon2 = map(math.radians,end)
+	a = (math.sin((lat2 - lat1) / 2) ** 2 +
+		math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+	return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def parse_upload(uploaded):
+	"""Generator of entries from an uploaded CSV or GPX file."""
+	suffix = Path(uploaded.name).suffix.lower()
+	if suffix == '.gpx':
+		yield parse_gpx(uploaded,uploaded.name)
+	elif suffix == '.csv':
+		lines = io.TextIOWrapper(uploaded.file,encoding='utf-8-sig',newline='')
+		yield from parse_csv(lines,uploaded.name)
+	else:
+		raise ImportFileError(f'{uploaded.name}: only CSV and GPX files can be imported')
+
+
+def parse_path(path):
+	"""
+	Returns list of entries in the CSV or GPX file at path. Used by worker
+	processes, so the whole file's entries are returned at once.
+	"""
+	return list(iter_path(path))
+
+
+def iter_path(path):
+	"""Generator of entries from the CSV or GPX file at path."""
+	path = Path(path)
+	suffix = path.suffix.lower()
+	if suffix == '.gpx':
+		with path.open('rb') as file:
+			yield parse_gpx(file,path.name)
+	elif suffix == '.csv':
+		with path.open(encoding='utf-8-sig',newline='') as lines:
+			yield from parse_csv(lines,path.name)
+	else:
+		raise ImportFileError(f'{path.name}: only CSV and GPX files can be imported')
+
+
+def iter_paths(paths,jobs=1):
+	"""
+	Generator of entries from all files in paths. With more than one job,
+	files are parsed in parallel by a pool of that many processes, and entries
+	are yielded file by file in the order given.
+	"""
+	if jobs <= 1:
+		for path in paths:
+			yield from iter_path(path)
+		return
+	with ProcessPoolExecutor(max_workers=jobs) as executor:
+		for entries in executor.map(parse_path,paths):
+			yield from entries
+
+
+def save_entries(user,entries,batch_size=IMPORT_BATCH_SIZE):
+	"""
+	Saves entries as user's completed activities and history, and adds their
+	distances to user's weekly distance, in one transaction. Rows are created
+	batch_size at a time as entries are read, so any number of entries can
+	be imported. Returns (number of entries, number of weeks updated).
+	"""
+	count = 0
+	weeks = {}
+	with transaction.atomic():
+		for batch in iter_batches(entries,batch_size):
+			CompletedAct.objects.bulk_create([
+				CompletedAct(
+					owner=user,
+					date_done=entry_date,
+					name=name,
+					distance=distance or 0,
+					)
+				for entry_date,name,distance in batch
+				],batch_size)
+			ActivityLog.objects.bulk_create([
+				ActivityLog(owner=user,date=entry_date,name=name,distance=distance)
+				for entry_date,name,distance in batch
+				],batch_size)
+			for entry_date,_,distance in batch:
+				if distance:
+					week_start = views.get_initial_date(entry_date)
+					weeks[week_start] = weeks.get(week_start,0) + distance
+			count += len(batch)
+		add_weekly_mileage(user,weeks,batch_size)
+	caching.invalidate_schedule(user.id)
+	return count,len(weeks)
+
+
+def iter_batches(entries,batch_size):
+	"""Generator of lists of up to batch_size entries."""
+	entries = iter(entries)
+	while True:
+		batch = list(itertools.islice(entries,batch_size))
+		if not batch:
+			return
+		yield batch
+
+
+def add_weekly_mileage(user,weeks,batch_size=IMPORT_BATCH_SIZE):
+	"""
+	Adds distances in weeks, dict mapping week start date to distance, to
+	user's weekly distance. Existing weeks are read and locked in one query,
+	then updated and created in bulk. If another request creates one of the
+	new weeks first, they are added one at a time instead.
+	"""
+	if not weeks:
+		return
+	weeks = dict(weeks)
+	existing = WeeklyMileage.objects.select_for_update().filter(
+		owner=user,
+		week_start__range=(min(weeks),max(weeks)),
+		)
+	updated = []
+	for week in existing:
+		if week.week_start in weeks:
+			week.distance += weeks.pop(week.week_start)
+			updated.append(week)
+	WeeklyMileage.objects.bulk_update(updated,['distance'],batch_size)
+	try:
+		with transaction.atomic():
+			WeeklyMileage.objects.bulk_create([
+				WeeklyMileage(owner=user,week_start=week_start,distance=distance)
+				for week_start,distance in weeks.items()
+				],batch_size)
+	except IntegrityError:
+		for week_start,distance in weeks.items():
+			views.update_mileage(user,week_start,distance)
@@ -0,0 +1,237 @@
+"""
+Per-request timing of SQL queries, named phases and template rendering.
+
+TimingMiddleware (in planner.middleware) starts a RequestTimings for each
+sampled request. While it is active, every query on the default database is
+counted and timed, and code can time named phases with
+
+	with phase('schedule_overlay'):
+		...
+
+Phases outside a timed request cost one context variable lookup. Templates
+are timed as the 'render' phase when TEMPLATES uses TimedDjangoTemplates.
+
+Views can also be given a query budget, the most queries a request to them
+should make, with @query_budget(n) or by view name in settings.QUERY_BUDGETS.
+QueryBudgetMiddleware checks requests against them, see budget_report.
+
+Queries are passed to the recorders of the request being handled, see
+recording, by an execute wrapper on every database connection. So queries
+async views run in worker threads are counted too, as the threads share the
+request's context variables.
+"""
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.template import TemplateDoesNotExist
+from django.template.backends.django import DjangoTemplates, Template, reraise
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import partial
+from pathlib import Path
+import threading
+import time
+import traceback
+
+# Timings of the request being handled, None if it is not being timed.
+_timings = ContextVar('planner_timings',default=None)
+# Recorders passed the queries of the request being handled.
+_recorders = ContextVar('planner_query_recorders',default=())
+# Requests checked against and over their query budget, by view name, in this
+# process.
+_budget_stats = {}
+_budget_stats_lock = threading.Lock()
+# Queries are traced back to the innermost frame in planner code.
+PLANNER_DIR = str(Path(__file__).resolve().parent)
+
+
+class QueryBudgetExceeded(Exception):
+	"""Raised when a view makes more queries than its budget allows."""
+
+
+class QueryRecorder:
+	"""Database execute wrapper counting queries and the time spent in them."""
+	def __init__(self):
+		self.count = 0
+		self.seconds = 0.0
+		# Queries may be recorded from several threads at once.
+		self.lock = threading.Lock()
+
+	def __call__(self,execute,sql,params,many,context):
+		start = time.perf_counter()
+		try:
+			return execute(sql,params,many,context)
+		finally:
+			with self.lock:
+				self.count += 1
+				self.seconds += time.perf_counter() - start
+
+
+class QueryLog(QueryRecorder):
+	"""QueryRecorder which also keeps each query's SQL and where it came from."""
+	def __init__(self):
+		super().__init__()
+		self.queries = []
+
+	def __call__(self,execute,sql,params,many,context):
+		self.queries.append((sql,query_origin()))
+		return super().__call__(execute,sql,params,many,context)
+
+	def repeated(self):
+		"""Return list of (sql, times run, origins) for SQL run more than once."""
+		origins = {}
+		for sql,origin in self.queries:
+			origins.setdefault(sql,[]).append(origin)
+		return [
+			(sql,len(sql_origins),sorted(set(sql_origins)))
+			for sql,sql_origins in origins.items() if len(sql_origins) > 1
+			]
+
+
+@contextmanager
+def recording(recorder):
+	"""
+	Pass queries made inside the block to execute wrapper recorder, including
+	those made in threads started from it with asgiref's sync_to_async.
+	"""
+	token = _recorders.set((*_recorders.get(),recorder))
+	try:
+		yield recorder
+	finally:
+		_recorders.reset(token)
+
+
+def record_queries(execute,sql,params,many,context):
+	"""Execute wrapper on every connection, calling the active recorders."""
+	for recorder in _recorders.get():
+		execute = partial(recorder,execute)
+	return execute(sql,params,many,context)
+
+
+@receiver(connection_created)
+def add_record_queries(sender,connection,**kwargs):
+	# Connections are created again after being closed.
+	if record_queries not in connection.execute_wrappers:
+		connection.execute_wrappers.append(record_queries)
+
+
+def query_origin():
+	"""Return 'file:line in function' of innermost planner code in the stack."""
+	for frame in reversed(traceback.extract_stack()):
+		if frame.filename.startswith(PLANNER_DIR) and frame.filename != __file__:
+			path = Path(frame.filename).relative_to(Path(PLANNER_DIR).parent)
+			return f'{path}:{frame.lineno} in {frame.name}'
+	return 'outside planner'
+
+
+def query_budget(max_queries):
+	"""
+	View decorator giving the most queries a request to the view should make.
+	A budget for the view's name in settings.QUERY_BUDGETS takes priority.
+	"""
+	def decorator(view):
+		view.query_budget = max_queries
+		return view
+	return decorator
+
+
+def count_budget(view_name,over):
+	with _budget_stats_lock:
+		stats = _budget_stats.setdefault(view_name,{'requests':0,'over_budget':0})
+		stats['requests'] += 1
+		if over:
+			stats['over_budget'] += 1
+
+
+def query_budget_stats():
+	"""Return dict of request and over budget counts by view in this process."""
+	with _budget_stats_lock:
+		return {name:dict(stats) for name,stats in _budget_stats.items()}
+
+
+def budget_report(view_name,budget,queries):
+	"""Describe an over budget request, with any repeated SQL and its origins."""
+	lines = [f'{view_name} made {queries.count} queries, budget is {budget}.']
+	repeated = queries.repeated()
+	if repeated:
+		lines.append('Repeated SQL:')
+	for sql,count,origins in repeated:
+		lines.append(f'  {count} x {sql}')
+		lines += [f'      from {origin}' for origin in origins]
+	return '\n'.join(lines)
+
+
+class RequestTimings:
+	"""Query count and time, and time in each named phase, for one request."""
+	def __init__(self):
+		self.queries = QueryRecorder()
+		self.phases = {}
+		self.start = time.perf_counter()
+		self.total = 0.0
+
+	def add(self,name,seconds):
+		self.phases[name] = self.phases.get(name,0.0) + seconds
+
+	def server_timing(self):
+		"""Return timings as a Server-Timing header value, durations in ms."""
+		metrics = [
+			f'total;dur={self.total * 1000:.2f}',
+			f'sql;dur={self.queries.seconds * 1000:.2f};desc="{self.queries.count} queries"',
+			]
+		metrics += [
+			f'{name};dur={seconds * 1000:.2f}' for name,seconds in self.phases.items()]
+		return ', '.join(metrics)
+
+	def as_dict(self):
+		"""Return timings as a dict for logging, durations in ms."""
+		return {
+			'total_ms':round(self.total * 1000,2),
+			'queries':self.queries.count,
+			'sql_ms':round(self.queries.seconds * 1000,2),
+			'phases':{
+				name:round(seconds * 1000,2) for name,seconds in self.phases.items()},
+			}
+
+
+@contextmanager
+def timed_request():
+	"""Time queries and phases run inside the block, yields RequestTimings."""
+	timings = RequestTimings()
+	token = _timings.set(timings)
+	try:
+		with recording(timings.queries):
+			yield timings
+	finally:
+		timings.total = time.perf_counter() - timings.start
+		_timings.reset(token)
+
+
+@contextmanager
+def phase(name):
+	"""Add time spent in the block to phase name of the current request."""
+	timings = _timings.get()
+	if timings is None:
+		yield
+		return
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		timings.add(name,time.perf_counter() - start)
+
+
+class TimedTemplate(Template):
+	def render(self,context=None,request=None):
+		with phase('render'):
+			return super().render(context,request)
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+	"""Django template backend which times rendering as the 'render' phase."""
+	def from_string(self,template_code):
+		return TimedTemplate(self.engine.from_string(template_code),self)
+
+	def get_template(self,template_name):
+		try:
+			return TimedTemplate(self.engine.get_template(template_name),self)
+		except TemplateDoesNotExist as exc:
+			reraise(exc,self)
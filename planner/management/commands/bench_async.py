@@ -0,0 +1,146 @@
+"""
+Compares latency of the sync and async versions of the home, history and
+mileage views under concurrent load. Requests are sent straight to the ASGI
+application, as an ASGI server would, many at once, as an existing user
+(e.g. one seeded with seed_load), e.g.
+
+	python manage.py seed_load --users 200
+	python manage.py bench_async load_100 --concurrency 20 --requests 400
+
+Async views run their queries in worker threads, each with its own database
+connection, so the data must be committed, which is why nothing is seeded.
+Works with any database backend, though SQLite gains less from concurrency.
+"""
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, override_settings
+from django.urls import include, path, reverse
+import asyncio
+import statistics
+import time
+
+from planner import views
+from runproj2.urls import urlpatterns as root_urlpatterns
+
+# The usual URLs, with both versions of each benchmarked view added under
+# sync/ and async/. Used as ROOT_URLCONF while benchmarking.
+BENCHED_VIEWS = {
+	'home':(views.home,views.async_home),
+	'history':(views.view_history,views.async_view_history),
+	'mileage':(views.mileage,views.async_mileage),
+	}
+urlpatterns = [
+	*root_urlpatterns,
+	path('bench/sync/',include(([
+		path(f'{name}/',sync_view,name=name)
+		for name,(sync_view,_) in BENCHED_VIEWS.items()
+		],'bench_sync'))),
+	path('bench/async/',include(([
+		path(f'{name}/',async_view,name=name)
+		for name,(_,async_view) in BENCHED_VIEWS.items()
+		],'bench_async'))),
+	]
+
+
+class Command(BaseCommand):
+	help = 'Compare latency of sync and async views under concurrent requests.'
+
+	def add_arguments(self,parser):
+		parser.add_argument('username',
+			help='User the requests are made as.')
+		parser.add_argument('--concurrency',type=int,default=20,
+			help='Requests in progress at once.')
+		parser.add_argument('--requests',type=int,default=200,
+			help='Requests timed for each view and version.')
+
+	def handle(self,*args,**options):
+		try:
+			user = User.objects.get(username=options['username'])
+		except User.DoesNotExist:
+			raise CommandError(f'No user called {options["username"]}.')
+		client = Client()
+		client.force_login(user)
+		session = client.cookies[settings.SESSION_COOKIE_NAME].value
+		headers = [
+			(b'host',b'testserver'),
+			(b'cookie',f'{settings.SESSION_COOKIE_NAME}={session}'.encode()),
+			]
+		try:
+			with override_settings(
+					ROOT_URLCONF=__name__,
+					ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS,'testserver']):
+				application = get_asgi_application()
+				for name in BENCHED_VIEWS:
+					for version in ('sync','async'):
+						url = reverse(f'bench_{version}:{name}')
+						# Untimed request to warm up caches.
+						asyncio.run(self.load(application,url,headers,1,1))
+						timings,seconds = asyncio.run(self.load(application,url,headers,
+							options['concurrency'],options['requests']))
+						self.report(f'{name} {version}',timings,seconds)
+		finally:
+			client.logout()
+
+	async def load(self,application,url,headers,concurrency,requests):
+		"""
+		Send requests to url, concurrency at a time, return list of latencies
+		in ms and the total time taken in seconds.
+		"""
+		semaphore = asyncio.Semaphore(concurrency)
+		timings = []
+
+		async def timed_request():
+			async with semaphore:
+				start = time.perf_counter()
+				status = await asgi_get(application,url,headers)
+				timings.append((time.perf_counter() - start) * 1000)
+			if status >= 400:
+				raise CommandError(f'{url} returned {status}')
+
+		start = time.perf_counter()
+		await asyncio.gather(*(timed_request() for _ in range(requests)))
+		return timings,time.perf_counter() - start
+
+	def report(self,name,timings,seconds):
+		if len(timings) < 2:
+			percentiles = timings * 99
+		else:
+			percentiles = statistics.quantiles(timings,n=100,method='inclusive')
+		self.stdout.write(
+			f'{name:14} p50 {percentiles[49]:8.2f} ms '
+			f'p95 {percentiles[94]:8.2f} ms '
+			f'p99 {percentiles[98]:8.2f} ms '
+			f'{len(timings) / seconds:8.1f} requests/s')
+
+
+async def asgi_get(application,url,headers):
+	"""Send GET request for url to ASGI application, return response status."""
+	path,_,query = url.partition('?')
+	scope = {
+		'type':'http',
+		'asgi':{'version':'3.0'},
+		'http_version':'1.1',
+		'method':'GET',
+		'scheme':'http',
+		'path':path,
+		'raw_path':path.encode(),
+		'query_string':query.encode(),
+		'root_path':'',
+		'headers':headers,
+		'client':('127.0.0.1',0),
+		'server':('testserver',80),
+		}
+	status = None
+
+	async def receive():
+		return {'type':'http.request','body':b'','more_body':False}
+
+	async def send(message):
+		nonlocal status
+		if message['type'] == 'http.response.start':
+			status = message['status']
+
+	await application(scope,receive,send)
+	return status
@@ -0,0 +1,103 @@
+"""
+Seeds a large number of users' activities and completed activities into the
+configured database (SQLite by default, Postgres when DATABASE_URL is set),
+then prints the query plans of the owner-filtered queries used by the planner
+views, with and without the composite owner indexes. All changes are rolled
+back when the command finishes.
+"""
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from datetime import date, timedelta
+
+from planner.models import Activity, CompletedAct
+
+
+class Command(BaseCommand):
+	help = 'Compare query plans with and without the composite owner indexes.'
+
+	def add_arguments(self,parser):
+		parser.add_argument('--users',type=int,default=100000,
+			help='Number of users to seed.')
+		parser.add_argument('--rows',type=int,default=5,
+			help='Activities and completed activities seeded per user.')
+		parser.add_argument('--batch',type=int,default=5000,
+			help='bulk_create batch size.')
+
+	def handle(self,*args,**options):
+		with transaction.atomic():
+			owner_id = self.seed(options['users'],options['rows'],options['batch'])
+			self.show_plans(owner_id,'With composite owner indexes')
+			# Drop the composite indexes, leaving only the single column
+			# foreign key indexes.
+			with connection.cursor() as cursor:
+				for model in (Activity,CompletedAct):
+					for index in model._meta.indexes:
+						cursor.execute(
+							f'DROP INDEX {connection.ops.quote_name(index.name)}')
+			self.show_plans(owner_id,'Without composite owner indexes')
+			transaction.set_rollback(True)
+
+	def seed(self,n_users,n_rows,batch):
+		"""Bulk create users and rows, return id of a user in the middle."""
+		self.stdout.write(f'Seeding {n_users} users, {n_rows} rows each...')
+		User.objects.bulk_create(
+			(User(username=f'bench_idx_{i}',password='!') for i in range(n_users)),
+			batch_size=batch,
+			)
+		user_ids = list(User.objects.filter(
+			username__startswith='bench_idx_').values_list('id',flat=True))
+		today = date.today()
+		activities = []
+		completed_acts = []
+		for user_id in user_ids:
+			for i in range(n_rows):
+				activities.append(Activity(
+					owner_id=user_id,
+					name=f'Activity {i}',
+					last_done=today - timedelta(days=i),
+					))
+				completed_acts.append(CompletedAct(
+					owner_id=user_id,
+					name=f'Activity {i}',
+					date_done=today - timedelta(days=i * 3),
+					distance=5,
+					))
+			if len(activities) >= batch:
+				Activity.objects.bulk_create(activities,batch_size=batch)
+				CompletedAct.objects.bulk_create(completed_acts,batch_size=batch)
+				activities = []
+				completed_acts = []
+		Activity.objects.bulk_create(activities,batch_size=batch)
+		CompletedAct.objects.bulk_create(completed_acts,batch_size=batch)
+		if connection.vendor == 'postgresql':
+			with connection.cursor() as cursor:
+				cursor.execute('ANALYZE')
+		return user_ids[len(user_ids) // 2]
+
+	def show_plans(self,owner_id,heading):
+		"""Print query plans for the hot owner-filtered queries."""
+		today = date.today()
+		queries = {
+			'Schedule overlay': CompletedAct.objects.filter(
+				owner=owner_id,
+				date_done__range=(today - timedelta(days=13),today),
+				),
+			'Completed act purge': CompletedAct.objects.filter(
+				owner=owner_id,
+				date_done__lte=today - timedelta(days=29),
+				),
+			'Activity list': Activity.objects.filter(owner=owner_id),
+			}
+		self.stdout.write(self.style.MIGRATE_HEADING(heading))
+		for name,queryset in queries.items():
+			sql,params = queryset.query.sql_with_params()
+			prefix = connection.ops.explain_query_prefix()
+			with connection.cursor() as cursor:
+				# Heading comment makes the statement text unique, so SQLite
+				# does not reuse a plan prepared before the indexes were dropped.
+				cursor.execute(f'{prefix} {sql} /* {heading} */',params)
+				rows = cursor.fetchall()
+			self.stdout.write(f'{name}:')
+			for row in rows:
+				self.stdout.write('  ' + ' '.join(str(value) for value in row))
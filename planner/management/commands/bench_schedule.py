@@ -0,0 +1,80 @@
+"""
+Micro-benchmark for building the 14 Day objects and plan day list used by the
+home page schedule. Compares the current slotted Day and PLAN_DAYS table with
+the previous dict based Day, strftime and list concatenation, reporting time
+and memory allocated per schedule build.
+"""
+from django.core.management.base import BaseCommand
+from datetime import date, timedelta
+import timeit
+import tracemalloc
+
+from planner.views import Day, PLAN_DAYS, dateFormat, rest_string, get_initial_date
+
+
+class LegacyDay:
+	"""Day as it was before __slots__, for comparison."""
+	def __init__(self,day_date,name=rest_string):
+		self.date_str = day_date.strftime(dateFormat)
+		if day_date == date.today():
+			self.date_str = 'Today'
+		self.name = name
+		self.complete = False
+		self.past = False
+		self.act_id = 0
+		self.date_iso = day_date.isoformat()
+		self.link = False
+
+
+def legacy_plan_days(plan_length,week):
+	"""Previous plan day selection, rebuilt on every call."""
+	plan_days = [1,2,3,4,5,6,7,1,2,3,4,5,6,7]
+	a = [1,2,3,4,5,6,7]
+	b = [8,9,10,11,12,13,14]
+	c = [15,16,17,18,19,20,21]
+	d = [22,23,24,25,26,27,28]
+	if plan_length != 1:
+		if week == 0:
+			plan_days = a + b
+		if week == 1:
+			if plan_length == 2:
+				plan_days = b + a
+			if plan_length == 4:
+				plan_days = b + c
+		if week == 2:
+			plan_days = c + d
+		if week == 3:
+			plan_days = d + a
+	return plan_days
+
+
+def build_legacy(start_date):
+	days = [LegacyDay(start_date+timedelta(days=i)) for i in range(14)]
+	return days,legacy_plan_days(4,1)
+
+
+def build_current(start_date):
+	today = date.today()
+	days = [Day(start_date+timedelta(days=i),rest_string,today) for i in range(14)]
+	return days,PLAN_DAYS[(4,1)]
+
+
+class Command(BaseCommand):
+	help = 'Compare time and memory used building schedule Day lists.'
+
+	def add_arguments(self,parser):
+		parser.add_argument('--number',type=int,default=20000,
+			help='Number of schedule builds to time.')
+
+	def handle(self,*args,**options):
+		start_date = get_initial_date(date.today())
+		for name,build in (('legacy',build_legacy),('current',build_current)):
+			seconds = timeit.timeit(lambda: build(start_date),number=options['number'])
+			# Memory held by one built schedule.
+			tracemalloc.start()
+			schedule = build(start_date)
+			size,_ = tracemalloc.get_traced_memory()
+			tracemalloc.stop()
+			self.stdout.write(
+				f'{name:8} {seconds / options["number"] * 1e6:8.1f} us/build '
+				f'{size:8} bytes/build')
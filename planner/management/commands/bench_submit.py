@@ -0,0 +1,89 @@
+"""
+Benchmarks the write cost of recording a completed activity. Compares
+save_completion, which writes in one transaction and saves only changed
+columns, with the pipeline the submit view used before it, of separate
+autocommit writes and full row saves. Runs against the configured database
+so commit costs are real, using a temporary user which is deleted
+afterwards.
+
+The previous pipeline no longer exists in the views, so legacy_completion
+reconstructs it line for line from the old submit view. It runs against the
+current models and helpers (e.g. update_mileage now rounds distances), so
+its numbers approximate the old code rather than measure it exactly.
+"""
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from datetime import date, timedelta
+import time
+import uuid
+
+from planner.models import Profile, PacedRun, CompletedAct
+from planner import caching
+from planner.views import save_completion, update_history, update_mileage
+
+
+def legacy_completion(user,date_done,activity,post,profile):
+	"""
+	Reconstruction of the submit view's body before save_completion: every
+	write in its own autocommit, full row saves.
+	"""
+	distance = activity.distance or 0
+	CompletedAct(
+		owner=user,
+		date_done=date_done,
+		name=activity.name,
+		distance=distance,
+		).save()
+	activity.update(post,date_done)
+	if activity.progressive and post.get('completed'):
+		activity.progress()
+	activity.setvalues(profile)
+	activity.save()
+	update_history(user,date_done,distance,activity.name)
+	if distance:
+		update_mileage(user,date_done,distance)
+	profile.save()
+	caching.invalidate_schedule(user.id)
+
+
+class Command(BaseCommand):
+	help = 'Compare write cost of submitting completed activities.'
+
+	def add_arguments(self,parser):
+		parser.add_argument('--runs',type=int,default=200,
+			help='Number of submissions timed for each pipeline.')
+
+	def handle(self,*args,**options):
+		# Unique name, so it cannot clash with a real user or another run.
+		user = User.objects.create(
+			username=f'bench_submit_{uuid.uuid4().hex[:8]}',password='!')
+		try:
+			profile = Profile.objects.create(owner=user)
+			for name,pipeline in (
+				('previous',legacy_completion),
+				('current',save_completion),
+				):
+				self.run(name,pipeline,user,profile,options['runs'])
+		finally:
+			user.delete()
+
+	def run(self,name,pipeline,user,profile,runs):
+		activity = PacedRun(owner=user,minutes=30)
+		activity.setvalues(profile)
+		activity.save()
+		activity = PacedRun.objects.get(id=activity.id)
+		post = {'difficulty':'2','completed':'on'}
+		start_date = date.today() - timedelta(days=runs)
+		with CaptureQueriesContext(connection) as queries:
+			start = time.perf_counter()
+			for i in range(runs):
+				pipeline(user,start_date + timedelta(days=i),activity,post,profile)
+			seconds = time.perf_counter() - start
+		writes = [query for query in queries.captured_queries
+			if not query['sql'].startswith('SELECT')]
+		self.stdout.write(
+			f'{name:9} {seconds / runs * 1000:7.2f} ms/submit '
+			f'{len(queries.captured_queries) / runs:5.1f} queries/submit '
+			f'{len(writes) / runs:5.1f} writes/submit')
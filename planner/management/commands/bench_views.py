@@ -0,0 +1,169 @@
+"""
+End-to-end benchmark of the main planner views. For each dataset size the
+database is seeded with seed_load, then each view is requested through the
+test client as one of the seeded users, recording latency percentiles, SQL
+query count and time, and peak memory allocated while handling the request.
+All seeded data is rolled back when the command finishes.
+
+Results are written as JSON. Given a --baseline file from an earlier run,
+the command fails if any view got slower or used more memory by more than
+--threshold, or made more queries, e.g.
+
+	python manage.py bench_views --output baseline.json
+	python manage.py bench_views --baseline baseline.json
+"""
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.urls import reverse
+from datetime import date
+from io import StringIO
+import json
+import statistics
+import time
+import tracemalloc
+
+from planner.instrumentation import QueryRecorder
+from planner.models import Activity, Profile
+
+# Metrics compared against the baseline, and whether any increase fails.
+COMPARED = {'p95_ms':False,'peak_kib':False,'queries':True}
+
+
+class Command(BaseCommand):
+	help = 'Benchmark planner views against seeded datasets of increasing size.'
+
+	def add_arguments(self,parser):
+		parser.add_argument('--sizes',default='100,500',
+			help='Comma separated numbers of users to seed, one run each.')
+		parser.add_argument('--years',type=float,default=1,
+			help='Years of history seeded per user.')
+		parser.add_argument('--runs',type=int,default=50,
+			help='Timed requests per view.')
+		parser.add_argument('--seed',type=int,default=0,
+			help='Random seed passed to seed_load.')
+		parser.add_argument('--output',default='bench_views.json',
+			help='File the JSON results are written to.')
+		parser.add_argument('--baseline',
+			help='JSON results of an earlier run to compare against.')
+		parser.add_argument('--threshold',type=float,default=0.2,
+			help='Allowed fractional increase in latency and memory.')
+
+	def handle(self,*args,**options):
+		sizes = [int(size) for size in options['sizes'].split(',')]
+		results = {}
+		for size in sizes:
+			with transaction.atomic():
+				call_command('seed_load',users=size,years=options['years'],
+					seed=options['seed'],end=date.today(),prefix='bench_views_',
+					stdout=StringIO())
+				results[str(size)] = self.bench_size(size,options['runs'])
+				transaction.set_rollback(True)
+		report = {
+			'vendor':connection.vendor,
+			'years':options['years'],
+			'runs':options['runs'],
+			'results':results,
+			}
+		with open(options['output'],'w') as file:
+			json.dump(report,file,indent=2)
+		self.stdout.write(f'Results written to {options["output"]}.')
+		if options['baseline']:
+			self.compare(report,options['baseline'],options['threshold'])
+
+	def bench_size(self,size,runs):
+		"""Benchmark every view as a seeded user, return dict of view results."""
+		# A user from the middle of the seeded users.
+		user = User.objects.get(username=f'bench_views_{size // 2}')
+		client = Client()
+		client.force_login(user)
+		self.stdout.write(self.style.MIGRATE_HEADING(f'{size} users'))
+		results = {}
+		with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS,'testserver']):
+			for name,method,url,data in self.view_requests(user):
+				results[name] = self.bench_view(client,method,url,data,runs)
+				self.stdout.write(
+					f'{name:20} p50 {results[name]["p50_ms"]:8.2f} ms '
+					f'p95 {results[name]["p95_ms"]:8.2f} ms '
+					f'p99 {results[name]["p99_ms"]:8.2f} ms '
+					f'{results[name]["queries"]:5} queries '
+					f'{results[name]["sql_ms"]:7.2f} ms SQL '
+					f'{results[name]["peak_kib"]:8.1f} KiB peak')
+		return results
+
+	def view_requests(self,user):
+		"""Return list of (name, method, url, post data) for each view."""
+		activity = Activity.objects.filter(owner=user).first()
+		profile = Profile.objects.get(owner=user)
+		submit_url = reverse('planner:submitdate',
+			args=[activity.id,date.today().isoformat()])
+		plan = {
+			f'day_{i + 1}':activity.id if i % 2 else 'REST'
+			for i in range(profile.plan_length * 7)
+			}
+		return [
+			('home','get',reverse('planner:home'),None),
+			('submit','get',submit_url,None),
+			('submit_post','post',submit_url,{'difficulty':'2','completed':'on'}),
+			('generate_plan','get',reverse('planner:generate'),None),
+			('generate_plan_post','post',reverse('planner:generate'),plan),
+			('view_history','get',reverse('planner:history'),None),
+			('mileage','get',reverse('planner:mileage'),None),
+			]
+
+	def bench_view(self,client,method,url,data,runs):
+		"""
+		Time runs requests to url, after one untimed warm up request. Query
+		count and time are averaged over the timed requests, memory is from a
+		separate request.
+		"""
+		request = getattr(client,method)
+		cache.clear()
+		request(url,data)
+		timings = []
+		queries = QueryRecorder()
+		with connection.execute_wrapper(queries):
+			for _ in range(runs):
+				start = time.perf_counter()
+				response = request(url,data)
+				timings.append((time.perf_counter() - start) * 1000)
+				if response.status_code >= 400:
+					raise CommandError(f'{url} returned {response.status_code}')
+		# Measured separately as tracemalloc slows everything down.
+		tracemalloc.start()
+		request(url,data)
+		_,peak = tracemalloc.get_traced_memory()
+		tracemalloc.stop()
+		percentiles = statistics.quantiles(timings,n=100,method='inclusive')
+		return {
+			'p50_ms':round(percentiles[49],3),
+			'p95_ms':round(percentiles[94],3),
+			'p99_ms':round(percentiles[98],3),
+			'queries':round(queries.count / runs,1),
+			'sql_ms':round(queries.seconds / runs * 1000,3),
+			'peak_kib':round(peak / 1024,1),
+			}
+
+	def compare(self,report,baseline_path,threshold):
+		"""Raise CommandError listing any views which regressed past baseline."""
+		with open(baseline_path) as file:
+			baseline = json.load(file)['results']
+		regressions = []
+		for size,views in report['results'].items():
+			for name,result in views.items():
+				old = baseline.get(size,{}).get(name)
+				if not old:
+					continue
+				for metric,strict in COMPARED.items():
+					limit = old[metric] if strict else old[metric] * (1 + threshold)
+					if result[metric] > limit:
+						regressions.append(
+							f'{size} users {name} {metric}: '
+							f'{result[metric]} > {old[metric]}')
+		if regressions:
+			raise CommandError('Regressions against baseline:\n' + '\n'.join(regressions))
+		self.stdout.write(self.style.SUCCESS('No regressions against baseline.'))
@@ -0,0 +1,47 @@
+"""
+Imports completed activities for a user from CSV or GPX files exported by
+other tools, e.g.
+
+	python manage.py import_activities runner runs.csv tracks/*.gpx --jobs 4
+
+See planner.importers for the supported file contents.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+import time
+
+from planner.importers import (iter_paths, save_entries, ImportFileError,
+	IMPORT_BATCH_SIZE)
+
+
+class Command(BaseCommand):
+	help = 'Import completed activities from CSV or GPX files.'
+
+	def add_arguments(self,parser):
+		parser.add_argument('username',
+			help='User the activities are imported for.')
+		parser.add_argument('files',nargs='+',
+			help='CSV or GPX files to import.')
+		parser.add_argument('--jobs',type=int,default=1,
+			help='Number of processes used to parse files in parallel.')
+		parser.add_argument('--batch',type=int,default=IMPORT_BATCH_SIZE,
+			help='Number of rows written per INSERT.')
+
+	def handle(self,*args,**options):
+		try:
+			user = User.objects.get(username=options['username'])
+		except User.DoesNotExist:
+			raise CommandError(f'No user called {options["username"]}.')
+		start = time.perf_counter()
+		try:
+			count,weeks = save_entries(
+				user,
+				iter_paths(options['files'],options['jobs']),
+				options['batch'],
+				)
+		except (ImportFileError,OSError) as error:
+			# Nothing is saved if any file fails.
+			raise CommandError(f'Import failed, nothing imported. {error}')
+		seconds = time.perf_counter() - start
+		self.stdout.write(
+			f'Imported {count} activities over {weeks} weeks in {seconds:.2f}s.')
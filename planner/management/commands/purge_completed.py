@@ -0,0 +1,44 @@
+"""
+Deletes completed activities older than the retention period for every user.
+Intended to be run as a nightly job, e.g. from Heroku Scheduler:
+
+	python manage.py purge_completed
+"""
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from datetime import date, timedelta
+
+from planner.models import CompletedAct
+from planner.views import COMPLETED_RETENTION_DAYS
+
+
+class Command(BaseCommand):
+	help = 'Delete completed activities older than the retention period.'
+
+	def add_arguments(self,parser):
+		parser.add_argument('--days',type=int,default=COMPLETED_RETENTION_DAYS,
+			help='Delete completed activities at least this many days old.')
+		parser.add_argument('--batch',type=int,default=1000,
+			help='Number of users purged per DELETE statement.')
+
+	def handle(self,*args,**options):
+		cutoff = date.today() - timedelta(days=options['days'])
+		total = 0
+		last_id = 0
+		# Walk users in id order, one DELETE per batch of users, so each
+		# statement uses the (owner, date_done) index and stays short.
+		while True:
+			user_ids = list(
+				User.objects.filter(id__gt=last_id)
+				.order_by('id')
+				.values_list('id',flat=True)[:options['batch']]
+				)
+			if not user_ids:
+				break
+			deleted, _ = CompletedAct.objects.filter(
+				owner__in=user_ids,
+				date_done__lte=cutoff,
+				).delete()
+			total += deleted
+			last_id = user_ids[-1]
+		self.stdout.write(f'Deleted {total} completed activities.')
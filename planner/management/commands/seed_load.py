@@ -0,0 +1,244 @@
+"""
+Seeds the configured database with a reproducible, realistically skewed data
+set for load testing and benchmarks: users with a long tail of activity
+counts, a mix of all activity types, plans of every length offered (1 to
+12 weeks) and years of completed activities, history and weekly distance.
+The same --seed and --end date always produce the same rows, e.g.
+
+	python manage.py seed_load --users 2000 --years 2 --seed 1
+
+Seeded users are called <prefix><n> and share the password given with
+--password, so benchmarks can log in as any of them.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import Max
+from datetime import date, timedelta
+from decimal import Decimal
+import math
+import random
+import time
+
+from planner.models import (Activity, PacedRun, Intervals, TimeTrial, CrossTrain,
+	Profile, PlanSlot, CompletedAct, ActivityLog, WeeklyMileage, PACES)
+
+# Share of each activity type among seeded activities.
+ACTIVITY_MIX = ((PacedRun,50),(Intervals,20),(TimeTrial,10),(CrossTrain,20))
+# Share of each plan length among seeded profiles.
+PLAN_LENGTH_MIX = ((1,20),(2,25),(3,10),(4,20),(6,10),(8,10),(12,5))
+CROSS_TRAINING = ('Swim','Bike','Rowing','Yoga','Weights')
+# Share of plan days which are rest days.
+REST_SHARE = 0.35
+
+
+class Command(BaseCommand):
+	help = 'Seed a reproducible data set of users, plans and history.'
+
+	def add_arguments(self,parser):
+		parser.add_argument('--users',type=int,default=2000,
+			help='Number of users to seed.')
+		parser.add_argument('--activities',type=int,default=24,
+			help='Median number of activities per user.')
+		parser.add_argument('--years',type=float,default=2,
+			help='Years of completed activities per user.')
+		parser.add_argument('--seed',type=int,default=0,
+			help='Random seed, the same seed gives the same data.')
+		parser.add_argument('--end',type=date.fromisoformat,default=date.today(),
+			help='Date of the last day of history (YYYY-MM-DD), default today.')
+		parser.add_argument('--batch',type=int,default=5000,
+			help='Number of rows written per INSERT.')
+		parser.add_argument('--prefix',default='load_',
+			help='Username prefix for seeded users.')
+		parser.add_argument('--password',default='load',
+			help='Password of seeded users.')
+		parser.add_argument('--clear',action='store_true',
+			help='Delete users seeded with the same prefix first.')
+
+	def handle(self,*args,**options):
+		self.rng = random.Random(options['seed'])
+		self.end = options['end']
+		self.batch = options['batch']
+		self.rows = {}
+		self.counts = {}
+		# Paces used to estimate distances, as for a new user.
+		self.pace_profile = Profile()
+		seeded = User.objects.filter(username__startswith=options['prefix'])
+		if seeded.exists():
+			if not options['clear']:
+				raise CommandError(
+					f'Users called {options["prefix"]}* already exist, '
+					'use --clear to replace them.')
+			seeded.delete()
+		start = time.perf_counter()
+		with transaction.atomic():
+			user_ids = self.create_users(
+				options['users'],options['prefix'],options['password'])
+			# Explicit ids let subclass rows and plan slots be written
+			# without reading back the rows they point to.
+			self.next_profile_id = self.next_id(Profile)
+			self.next_activity_id = self.next_id(Activity)
+			for user_id in user_ids:
+				self.seed_user(user_id,options['activities'],options['years'])
+			self.flush()
+			self.reset_sequences()
+		if connection.vendor == 'postgresql':
+			with connection.cursor() as cursor:
+				cursor.execute('ANALYZE')
+		seconds = time.perf_counter() - start
+		for model,count in self.counts.items():
+			self.stdout.write(f'{model.__name__:14} {count:9} rows')
+		self.stdout.write(
+			f'Seeded {sum(self.counts.values())} rows in {seconds:.1f}s.')
+
+	def create_users(self,n_users,prefix,password):
+		"""Bulk create users, return their ids in username order."""
+		password = make_password(password)
+		User.objects.bulk_create(
+			(User(username=f'{prefix}{i}',password=password) for i in range(n_users)),
+			batch_size=self.batch,
+			)
+		self.counts[User] = n_users
+		ids = dict(User.objects.filter(username__startswith=prefix)
+			.values_list('username','id'))
+		return [ids[f'{prefix}{i}'] for i in range(n_users)]
+
+	def next_id(self,model):
+		return (model.objects.aggregate(Max('id'))['id__max'] or 0) + 1
+
+	def seed_user(self,user_id,median_activities,years):
+		rng = self.rng
+		# Long tail of activity counts around the median.
+		n_activities = max(1,min(
+			int(rng.lognormvariate(math.log(median_activities),0.6)),
+			median_activities * 5,
+			))
+		activities = [self.make_activity(user_id) for _ in range(n_activities)]
+		plan_length = self.choose(PLAN_LENGTH_MIX)
+		this_monday = self.end - timedelta(days=self.end.weekday())
+		profile = Profile(
+			id=self.next_profile_id,
+			owner_id=user_id,
+			plan_length=plan_length,
+			plan_start_date=this_monday - timedelta(weeks=rng.randrange(52)),
+			)
+		self.next_profile_id += 1
+		self.add(profile)
+		for day_index in range(1,(plan_length * 7) + 1):
+			activity = None if rng.random() < REST_SHARE else rng.choice(activities)
+			self.add(PlanSlot(
+				profile_id=profile.id,
+				day_index=day_index,
+				activity_id=activity and activity.id,
+				))
+		# Days with an activity, a few favourite activities done most often.
+		active_share = rng.uniform(0.2,0.9)
+		weeks = {}
+		for days_ago in range(int(years * 365),0,-1):
+			if rng.random() > active_share:
+				continue
+			activity = activities[min(int(rng.expovariate(0.3)),n_activities - 1)]
+			day = self.end - timedelta(days=days_ago)
+			distance = Decimal(activity.distance or 0).quantize(Decimal('0.01'))
+			self.add(CompletedAct(owner_id=user_id,date_done=day,
+				name=activity.name,distance=distance))
+			self.add(ActivityLog(owner_id=user_id,date=day,
+				name=activity.name,distance=distance or None))
+			if distance:
+				week_start = day - timedelta(days=day.weekday())
+				weeks[week_start] = weeks.get(week_start,0) + distance
+		for week_start,distance in weeks.items():
+			self.add(WeeklyMileage(owner_id=user_id,week_start=week_start,
+				distance=distance))
+		if sum(len(rows) for rows in self.rows.values()) >= self.batch:
+			self.flush()
+
+	def make_activity(self,user_id):
+		"""Return new activity of a random type with realistic values."""
+		rng = self.rng
+		model = self.choose(ACTIVITY_MIX)
+		activity = model(
+			id=self.next_activity_id,
+			activity_ptr_id=self.next_activity_id,
+			owner_id=user_id,
+			difficulty=rng.choice('123'),
+			last_done=self.end - timedelta(days=rng.randrange(60)),
+			progressive=rng.random() < 0.3,
+			)
+		self.next_activity_id += 1
+		if model is PacedRun:
+			activity.pace = rng.choice(PACES)
+			if rng.random() < 0.7:
+				activity.minutes = rng.choice((20,30,40,45,60,90))
+				activity.goal_minutes = activity.minutes + 30
+				activity.prog_minutes = 5
+			else:
+				activity.distance = Decimal(rng.choice(('5','8','10','15','21.1')))
+				activity.goal_distance = activity.distance + 10
+				activity.prog_distance = Decimal('1')
+		elif model is Intervals:
+			activity.rep_length = rng.choice((200,400,800,1000))
+			activity.rep_number = rng.randint(4,12)
+			activity.rep_goal = activity.rep_number + 4
+		elif model is TimeTrial:
+			activity.distance = Decimal(rng.choice((1,3,5,10)))
+			activity.best = int(activity.distance * rng.randint(240,420))
+		else:
+			activity.exercise_type = rng.choice(CROSS_TRAINING)
+		activity.setvalues(self.pace_profile)
+		self.add(activity)
+		return activity
+
+	def choose(self,mix):
+		"""Return random choice from (value, weight) pairs."""
+		values,weights = zip(*mix)
+		return self.rng.choices(values,weights)[0]
+
+	def add(self,row):
+		self.rows.setdefault(type(row),[]).append(row)
+
+	def flush(self):
+		"""Write all buffered rows, parents before the rows pointing at them."""
+		for model in (Profile,PacedRun,Intervals,TimeTrial,CrossTrain,PlanSlot,
+				CompletedAct,ActivityLog,WeeklyMileage):
+			rows = self.rows.pop(model,[])
+			if not rows:
+				continue
+			if issubclass(model,Activity):
+				self.insert_activities(model,rows)
+			else:
+				model.objects.bulk_create(rows,batch_size=self.batch)
+			self.counts[model] = self.counts.get(model,0) + len(rows)
+
+	def insert_activities(self,model,rows):
+		"""
+		bulk_create does not support multi-table inheritance, so the Activity
+		rows are bulk created and the subclass rows inserted with executemany.
+		"""
+		Activity.objects.bulk_create(
+			[Activity(**{field.attname:getattr(row,field.attname)
+				for field in Activity._meta.concrete_fields}) for row in rows],
+			batch_size=self.batch,
+			)
+		fields = model._meta.local_concrete_fields
+		quote = connection.ops.quote_name
+		sql = (
+			f'INSERT INTO {quote(model._meta.db_table)} '
+			f'({", ".join(quote(field.column) for field in fields)}) '
+			f'VALUES ({", ".join(["%s"] * len(fields))})'
+			)
+		with connection.cursor() as cursor:
+			cursor.executemany(sql,[
+				[field.get_db_prep_save(getattr(row,field.attname),connection)
+					for field in fields]
+				for row in rows
+				])
+
+	def reset_sequences(self):
+		"""Move id sequences past the explicit ids used (Postgres only)."""
+		statements = connection.ops.sequence_reset_sql(no_style(),[Profile,Activity])
+		with connection.cursor() as cursor:
+			for sql in statements:
+				cursor.execute(sql)
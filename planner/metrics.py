@@ -0,0 +1,205 @@
+"""
+Request metrics in the Prometheus text exposition format, shared between
+worker processes without any outside service.
+
+MetricsMiddleware (in planner.middleware) records each request's latency and
+query count in histograms labelled by URL name, and views count completed
+activities submitted with inc(). Each worker process keeps its metrics in
+memory and writes them, with its schedule cache hits and query budget
+counts, to its own file in settings.METRICS_DIR every
+settings.METRICS_FLUSH_SECONDS, or only when scraped if it is 0. The
+/metrics view adds up the files of all workers, so one scrape covers them
+all.
+
+Worker files are named by process id and start time. Scrapes remove files
+not written for settings.METRICS_STALE_SECONDS, those of workers which have
+exited, so their counts are dropped. Prometheus takes the drop in a counter
+as a reset.
+"""
+from django.conf import settings
+from pathlib import Path
+import json
+import os
+import tempfile
+import threading
+import time
+
+from . import caching, instrumentation
+
+# Upper bounds of histogram buckets, request latency in seconds and queries.
+LATENCY_BUCKETS = (0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10)
+QUERY_BUCKETS = (1,2,4,6,8,10,15,20,30,50,100)
+# Type and help text of every metric, in the order they are exposed.
+METRICS = {
+	'planner_request_duration_seconds':('histogram','Request latency by view.'),
+	'planner_request_queries':('histogram','SQL queries per request by view.'),
+	'planner_submits_total':('counter','Completed activities submitted.'),
+	'planner_schedule_cache_hits_total':('counter','Schedule cache hits.'),
+	'planner_schedule_cache_misses_total':('counter','Schedule cache misses.'),
+	'planner_schedule_cache_hit_ratio':(
+		'gauge','Share of schedule cache lookups which were hits.'),
+	'planner_query_budget_requests_total':(
+		'counter','Requests checked against a query budget by view.'),
+	'planner_query_budget_exceeded_total':(
+		'counter','Requests over their query budget by view.'),
+	}
+
+# Metrics recorded in this process, keyed by (name, sorted label pairs).
+# Histogram values are (count in each bucket with +Inf last, sum).
+_counters = {}
+_histograms = {}
+_lock = threading.Lock()
+# Process the flush thread was started in, it does not survive a fork.
+_flush_pid = None
+# Tells this process's file apart from that of an earlier process with the
+# same id.
+_started = time.time_ns()
+
+
+def inc(name,amount=1,**labels):
+	"""Add amount to counter name."""
+	key = (name,tuple(sorted(labels.items())))
+	with _lock:
+		_counters[key] = _counters.get(key,0) + amount
+	start_flushing()
+
+
+def observe(name,value,buckets,**labels):
+	"""Record value in histogram name with the given bucket upper bounds."""
+	key = (name,tuple(sorted(labels.items())))
+	index = next((i for i,bound in enumerate(buckets) if value <= bound),len(buckets))
+	with _lock:
+		counts,total = _histograms.get(key,([0] * (len(buckets) + 1),0))
+		counts[index] += 1
+		_histograms[key] = (counts,total + value)
+	start_flushing()
+
+
+def observe_request(view_name,seconds,queries):
+	observe('planner_request_duration_seconds',seconds,LATENCY_BUCKETS,view=view_name)
+	observe('planner_request_queries',queries,QUERY_BUCKETS,view=view_name)
+
+
+def snapshot():
+	"""Return this process's metrics as a JSON serialisable dict."""
+	with _lock:
+		counters = [[name,dict(labels),value] for (name,labels),value in _counters.items()]
+		histograms = [
+			[name,dict(labels),list(counts),total]
+			for (name,labels),(counts,total) in _histograms.items()
+			]
+	cache_stats = caching.schedule_cache_stats()
+	counters += [
+		['planner_schedule_cache_hits_total',{},cache_stats['hits']],
+		['planner_schedule_cache_misses_total',{},cache_stats['misses']],
+		]
+	for view_name,stats in instrumentation.query_budget_stats().items():
+		counters += [
+			['planner_query_budget_requests_total',{'view':view_name},stats['requests']],
+			['planner_query_budget_exceeded_total',{'view':view_name},stats['over_budget']],
+			]
+	return {'counters':counters,'histograms':histograms}
+
+
+def metrics_dir():
+	return Path(getattr(settings,'METRICS_DIR',
+		Path(tempfile.gettempdir()) / 'planner-metrics'))
+
+
+def flush():
+	"""Write this process's metrics to its file in METRICS_DIR."""
+	directory = metrics_dir()
+	directory.mkdir(parents=True,exist_ok=True)
+	path = directory / f'worker-{os.getpid()}-{_started}.json'
+	temp_path = path.with_suffix('.tmp')
+	temp_path.write_text(json.dumps(snapshot()))
+	# Replaced in one step, so a scrape never reads a partly written file.
+	os.replace(temp_path,path)
+
+
+def start_flushing():
+	"""Start the thread writing metrics, once in each worker process."""
+	global _flush_pid
+	if _flush_pid == os.getpid() or not getattr(settings,'METRICS_FLUSH_SECONDS',5):
+		return
+	with _lock:
+		if _flush_pid == os.getpid():
+			return
+		_flush_pid = os.getpid()
+	threading.Thread(target=flush_forever,daemon=True,name='planner-metrics').start()
+
+
+def flush_forever():
+	interval = getattr(settings,'METRICS_FLUSH_SECONDS',5)
+	while True:
+		time.sleep(interval)
+		flush()
+
+
+def collect():
+	"""Return metrics of all worker processes added together."""
+	# This process's file may be up to METRICS_FLUSH_SECONDS out of date.
+	flush()
+	counters = {}
+	histograms = {}
+	stale = time.time() - getattr(settings,'METRICS_STALE_SECONDS',300)
+	for path in metrics_dir().glob('worker-*.json'):
+		try:
+			if path.stat().st_mtime < stale:
+				path.unlink(missing_ok=True)
+				continue
+			worker = json.loads(path.read_text())
+		except (OSError,ValueError):
+			# Removed or replaced while being read.
+			continue
+		for name,labels,value in worker['counters']:
+			key = (name,tuple(sorted(labels.items())))
+			counters[key] = counters.get(key,0) + value
+		for name,labels,counts,total in worker['histograms']:
+			key = (name,tuple(sorted(labels.items())))
+			old_counts,old_total = histograms.get(key,([0] * len(counts),0))
+			histograms[key] = (
+				[old + new for old,new in zip(old_counts,counts)],old_total + total)
+	hits = counters.get(('planner_schedule_cache_hits_total',()),0)
+	misses = counters.get(('planner_schedule_cache_misses_total',()),0)
+	gauges = {}
+	if hits + misses:
+		gauges[('planner_schedule_cache_hit_ratio',())] = hits / (hits + misses)
+	return counters,histograms,gauges
+
+
+def exposition():
+	"""Return metrics of all workers in the Prometheus text format."""
+	counters,histograms,gauges = collect()
+	values = {**counters,**gauges}
+	lines = []
+	for name,(kind,help_text) in METRICS.items():
+		lines += [f'# HELP {name} {help_text}',f'# TYPE {name} {kind}']
+		if kind == 'histogram':
+			buckets = LATENCY_BUCKETS if name.endswith('_seconds') else QUERY_BUCKETS
+			for key in sorted(key for key in histograms if key[0] == name):
+				counts,total = histograms[key]
+				cumulative = 0
+				for bound,count in zip((*buckets,'+Inf'),counts):
+					cumulative += count
+					lines.append(
+						f'{name}_bucket{format_labels(key[1],le=bound)} {cumulative}')
+				lines.append(f'{name}_sum{format_labels(key[1])} {total}')
+				lines.append(f'{name}_count{format_labels(key[1])} {cumulative}')
+		else:
+			for key in sorted(key for key in values if key[0] == name):
+				lines.append(f'{name}{format_labels(key[1])} {values[key]}')
+	return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels,**extra):
+	labels = [*labels,*extra.items()]
+	if not labels:
+		return ''
+	pairs = ','.join(f'{name}="{escape(value)}"' for name,value in labels)
+	return '{' + pairs + '}'
+
+
+def escape(value):
+	return str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
@@ -0,0 +1,192 @@
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import AnonymousUser
+from django.utils.crypto import constant_time_compare
+from django.utils.functional import SimpleLazyObject
+from django.utils.module_loading import import_string
+import json
+import logging
+import random
+import time
+
+from . import instrumentation, metrics, profiling
+from .models import Profile
+from .views import get_profile
+
+timing_logger = logging.getLogger('planner.timing')
+budget_logger = logging.getLogger('planner.queries')
+
+
+class ProfileMiddleware:
+	"""
+	Adds request.profile, the logged in user's Profile (or 0 if not logged
+	in). It is loaded the first time it is used and reused for the rest of
+	the request. Must come after AuthenticationMiddleware.
+
+	If settings.PROFILE_SELECT_USER is True, request.user is also replaced
+	so the session user and their profile are loaded in one joined query,
+	instead of one query each.
+	"""
+	def __init__(self,get_response):
+		self.get_response = get_response
+		self.select_user = getattr(settings,'PROFILE_SELECT_USER',False)
+
+	def __call__(self,request):
+		if self.select_user:
+			request.user = SimpleLazyObject(lambda: get_user_with_profile(request))
+		request.profile = SimpleLazyObject(lambda: get_profile(request.user))
+		return self.get_response(request)
+
+
+class MetricsMiddleware:
+	"""
+	Records every request's latency and query count by URL name, exposed by
+	the /metrics view (see planner.metrics). Should come first.
+	"""
+	def __init__(self,get_response):
+		self.get_response = get_response
+
+	def __call__(self,request):
+		start = time.perf_counter()
+		with instrumentation.recording(instrumentation.QueryRecorder()) as queries:
+			response = self.get_response(request)
+		match = request.resolver_match
+		metrics.observe_request(
+			match.view_name if match else 'unmatched',
+			time.perf_counter() - start,
+			queries.count,
+			)
+		return response
+
+
+class TimingMiddleware:
+	"""
+	Times a sampled fraction (settings.TIMING_SAMPLE_RATE) of requests: total
+	time, number of queries and time spent in them, and any named phases (see
+	planner.instrumentation). Timings are sent in a Server-Timing header and,
+	if settings.TIMING_LOG is True, logged as one JSON line to the 
+	planner.timing logger. Should come first, so other middleware is timed.
+	"""
+	def __init__(self,get_response):
+		self.get_response = get_response
+		self.sample_rate = getattr(settings,'TIMING_SAMPLE_RATE',1.0)
+		self.log = getattr(settings,'TIMING_LOG',False)
+
+	def __call__(self,request):
+		if random.random() >= self.sample_rate:
+			return self.get_response(request)
+		with instrumentation.timed_request() as timings:
+			response = self.get_response(request)
+		response['Server-Timing'] = timings.server_timing()
+		if self.log:
+			match = request.resolver_match
+			timing_logger.info(json.dumps({
+				'method':request.method,
+				'path':request.path,
+				'view':match.view_name if match else None,
+				'status':response.status_code,
+				**timings.as_dict(),
+				}))
+		return response
+
+
+class QueryBudgetMiddleware:
+	"""
+	Checks the queries made by views against their query budgets (see
+	planner.instrumentation.query_budget). With settings.QUERY_BUDGET_MODE
+	'raise', requests over budget raise QueryBudgetExceeded, with 'log' they
+	are logged as warnings to the planner.queries logger, both listing any
+	repeated SQL and where it was run from. With 'count' (for production) only
+	counters are kept, see instrumentation.query_budget_stats.
+	"""
+	def __init__(self,get_response):
+		self.get_response = get_response
+		self.budgets = getattr(settings,'QUERY_BUDGETS',{})
+		self.mode = getattr(settings,'QUERY_BUDGET_MODE','count')
+		if self.mode == 'count':
+			self.recorder = instrumentation.QueryRecorder
+		else:
+			self.recorder = instrumentation.QueryLog
+
+	def __call__(self,request):
+		# Every request is recorded, as its view is not known until resolved.
+		with instrumentation.recording(self.recorder()) as queries:
+			response = self.get_response(request)
+		match = request.resolver_match
+		if match:
+			budget = self.budgets.get(
+				match.view_name,getattr(match.func,'query_budget',None))
+			if budget is not None:
+				self.check(match.view_name,budget,queries)
+		return response
+
+	def check(self,view_name,budget,queries):
+		over = queries.count > budget
+		instrumentation.count_budget(view_name,over)
+		if not over or self.mode == 'count':
+			return
+		report = instrumentation.budget_report(view_name,budget,queries)
+		if self.mode == 'raise':
+			raise instrumentation.QueryBudgetExceeded(report)
+		budget_logger.warning(report)
+
+
+class ProfilingMiddleware:
+	"""
+	Profiles a sampled fraction (settings.PROFILE_SAMPLE_RATE) of requests,
+	and requests by staff users sending the settings.PROFILE_HEADER header,
+	saving the profiles with planner.profiling. Must come after
+	AuthenticationMiddleware.
+	"""
+	def __init__(self,get_response):
+		self.get_response = get_response
+		self.sample_rate = getattr(settings,'PROFILE_SAMPLE_RATE',0)
+		self.header = getattr(settings,'PROFILE_HEADER','X-Profile')
+
+	def __call__(self,request):
+		if not self.should_profile(request):
+			return self.get_response(request)
+		with profiling.RequestProfiler() as profiler:
+			response = self.get_response(request)
+		profiler.save(request,response)
+		return response
+
+	def should_profile(self,request):
+		if self.sample_rate and random.random() < self.sample_rate:
+			return True
+		# Header checked first, so other requests do not load the user.
+		return self.header in request.headers and request.user.is_staff
+
+
+def get_user_with_profile(request):
+	"""
+	Returns the session user with their profile already loaded, checking the
+	session the same way as django.contrib.auth.get_user. Falls back to
+	get_user for sessions from other backends, or users without a profile.
+	"""
+	try:
+		user_id = auth.get_user_model()._meta.pk.to_python(
+			request.session[auth.SESSION_KEY])
+		backend_path = request.session[auth.BACKEND_SESSION_KEY]
+	except KeyError:
+		return AnonymousUser()
+	if backend_path not in settings.AUTHENTICATION_BACKENDS:
+		return AnonymousUser()
+	backend = import_string(backend_path)()
+	if not isinstance(backend,ModelBackend):
+		return auth.get_user(request)
+	try:
+		profile = Profile.objects.select_related('owner').get(owner_id=user_id)
+	except Profile.DoesNotExist:
+		return auth.get_user(request)
+	user = profile.owner
+	if not backend.user_can_authenticate(user):
+		return AnonymousUser()
+	session_hash = request.session.get(auth.HASH_SESSION_KEY)
+	if not (session_hash and
+			constant_time_compare(session_hash,user.get_session_auth_hash())):
+		request.session.flush()
+		return AnonymousUser()
+	user.backend = backend_path
+	return user
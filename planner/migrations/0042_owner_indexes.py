@@ -0,0 +1,21 @@
+# Generated by Django 4.0.2 on 2026-10-18 09:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('planner', '0041_profile_pace_0_profile_pace_1_profile_pace_2_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['owner', 'last_done'], name='activity_owner_last_done_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='completedact',
+            index=models.Index(fields=['owner', 'date_done'], name='completedact_owner_date_idx'),
+        ),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 4.0.2 on 2026-10-18 09:33
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from datetime import date
+from decimal import Decimal, InvalidOperation
+import json
+
+
+def history_to_log(apps, schema_editor):
+    """Copy each profile's JSON history list into ActivityLog rows."""
+    Profile = apps.get_model('planner', 'Profile')
+    ActivityLog = apps.get_model('planner', 'ActivityLog')
+    for profile in Profile.objects.exclude(history=None).iterator():
+        history = profile.history
+        # History was saved as a JSON encoded string inside the JSONField.
+        if isinstance(history, str):
+            try:
+                history = json.loads(history)
+            except ValueError:
+                continue
+        entries = []
+        # Stored newest first; create oldest first so ids follow dates.
+        for entry in reversed(history):
+            try:
+                entry_date = date.fromisoformat(entry['date'])
+            except (KeyError, TypeError, ValueError):
+                continue
+            try:
+                distance = Decimal(entry.get('distance'))
+            except (InvalidOperation, TypeError):
+                distance = None
+            entries.append(ActivityLog(
+                owner_id=profile.owner_id,
+                date=entry_date,
+                name=str(entry.get('name', 'nameless'))[:40],
+                distance=distance,
+            ))
+        ActivityLog.objects.bulk_create(entries)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('planner', '0042_owner_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivityLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('name', models.CharField(default='nameless', max_length=40)),
+                ('distance', models.DecimalField(blank=True, decimal_places=2, max_digits=5, null=True)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-date', '-id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='activitylog',
+            index=models.Index(fields=['owner', '-date', '-id'], name='activitylog_owner_date_idx'),
+        ),
+        migrations.RunPython(history_to_log, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='profile',
+            name='history',
+        ),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 4.0.2 on 2026-10-18 09:34
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from datetime import date
+from decimal import Decimal, InvalidOperation
+import json
+
+
+def mileage_to_weekly(apps, schema_editor):
+    """Copy each profile's JSON mileage history into WeeklyMileage rows."""
+    Profile = apps.get_model('planner', 'Profile')
+    WeeklyMileage = apps.get_model('planner', 'WeeklyMileage')
+    # Users may still have several profiles (removed in 0047), so each week
+    # is added up across all of its owner's profiles.
+    weeks = {}
+    for profile in Profile.objects.exclude(mileage_history=None).iterator():
+        history = profile.mileage_history
+        # History was saved as a JSON encoded string inside the JSONField.
+        if isinstance(history, str):
+            try:
+                history = json.loads(history)
+            except ValueError:
+                continue
+        for entry in history:
+            try:
+                week_start = date.fromisoformat(entry['date'])
+                distance = Decimal(entry['distance'])
+            except (KeyError, TypeError, ValueError, InvalidOperation):
+                continue
+            key = (profile.owner_id, week_start)
+            weeks[key] = weeks.get(key, 0) + distance
+    WeeklyMileage.objects.bulk_create([
+        WeeklyMileage(
+            owner_id=owner_id,
+            week_start=week_start,
+            distance=distance,
+        )
+        for (owner_id, week_start), distance in weeks.items()
+    ], batch_size=1000)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('planner', '0043_activitylog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WeeklyMileage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('week_start', models.DateField()),
+                ('distance', models.DecimalField(decimal_places=2, default=0, max_digits=7)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-week_start'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='weeklymileage',
+            constraint=models.UniqueConstraint(fields=('owner', 'week_start'), name='weeklymileage_owner_week_unique'),
+        ),
+        migrations.RunPython(mileage_to_weekly, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='profile',
+            name='mileage_history',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.2 on 2026-10-18 09:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('planner', '0044_weeklymileage'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='profile',
+            name='plan_length',
+            field=models.PositiveSmallIntegerField(choices=[(1, '1 Week'), (2, '2 Weeks'), (3, '3 Weeks'), (4, '4 Weeks'), (6, '6 Weeks'), (8, '8 Weeks'), (12, '12 Weeks')], default=2),
+        ),
+    ]
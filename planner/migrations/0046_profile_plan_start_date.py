@@ -0,0 +1,41 @@
+# Generated by Django 4.0.2 on 2026-10-18 10:02
+
+from django.db import migrations
+from datetime import date, timedelta
+
+
+def schedule_to_plan_start(apps, schema_editor):
+    """
+    Turn each profile's current schedule start date and week into the date
+    its plan started. Profiles with a plan but no date start this week.
+    """
+    Profile = apps.get_model('planner', 'Profile')
+    this_monday = date.today() - timedelta(days=date.today().weekday())
+    for profile in Profile.objects.iterator():
+        if profile.plan_start_date:
+            profile.plan_start_date -= timedelta(weeks=profile.schedule_week)
+        elif profile.plan:
+            profile.plan_start_date = this_monday
+        else:
+            continue
+        profile.save(update_fields=['plan_start_date'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('planner', '0045_more_plan_lengths'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='profile',
+            old_name='schedule_init_date',
+            new_name='plan_start_date',
+        ),
+        migrations.RunPython(schedule_to_plan_start, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='profile',
+            name='schedule_week',
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.0.2 on 2026-10-18 09:38
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def remove_duplicate_profiles(apps, schema_editor):
+    """
+    Keep one profile per user, preferring the oldest one with a plan, so the
+    owner column can be made unique.
+    """
+    Profile = apps.get_model('planner', 'Profile')
+    duplicated = (Profile.objects.values('owner')
+        .annotate(count=models.Count('id')).filter(count__gt=1)
+        .values_list('owner', flat=True))
+    for owner_id in list(duplicated):
+        profiles = list(Profile.objects.filter(owner_id=owner_id).order_by('id'))
+        keep = next((profile for profile in profiles if profile.plan), profiles[0])
+        Profile.objects.filter(owner_id=owner_id).exclude(id=keep.id).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('planner', '0046_profile_plan_start_date'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_profiles, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='profile',
+            name='owner',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 4.0.2 on 2026-10-18 09:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+import json
+
+
+def plan_to_slots(apps, schema_editor):
+    """
+    Copy each profile's JSON plan into PlanSlot rows. Ids which are not one of
+    the user's activities (e.g. deleted ones) become rest days.
+    """
+    Profile = apps.get_model('planner', 'Profile')
+    PlanSlot = apps.get_model('planner', 'PlanSlot')
+    Activity = apps.get_model('planner', 'Activity')
+    for profile in Profile.objects.exclude(plan=None).iterator():
+        plan = profile.plan
+        # Plan was saved as a JSON encoded string inside the JSONField.
+        if isinstance(plan, str):
+            try:
+                plan = json.loads(plan)
+            except ValueError:
+                continue
+        if not isinstance(plan, dict):
+            continue
+        act_ids = set(Activity.objects.filter(owner_id=profile.owner_id)
+            .values_list('id', flat=True))
+        slots = []
+        for day_index in range(1, (profile.plan_length * 7) + 1):
+            value = str(plan.get(f'day_{day_index}', 'REST'))
+            activity_id = int(value) if value.isdigit() else None
+            slots.append(PlanSlot(
+                profile_id=profile.id,
+                day_index=day_index,
+                activity_id=activity_id if activity_id in act_ids else None,
+            ))
+        PlanSlot.objects.bulk_create(slots)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('planner', '0047_profile_owner_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlanSlot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day_index', models.PositiveSmallIntegerField()),
+                ('activity', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='plan_slots', to='planner.activity')),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='plan_slots', to='planner.profile')),
+            ],
+            options={
+                'ordering': ['day_index'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='planslot',
+            constraint=models.UniqueConstraint(fields=('profile', 'day_index'), name='planslot_profile_day_unique'),
+        ),
+        migrations.RunPython(plan_to_slots, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='profile',
+            name='plan',
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django import forms
 from django.db import models
+from django.db.models.query import ModelIterable
 from django.contrib.auth.models import User
 from django.core.validators import MaxValueValidator, MinValueValidator
 from decimal import Decimal
@@ -38,6 +39,8 @@ PACE_CHOICES = [
 	(PACES[3], PACE_LABELS[3]),
 	(PACES[4], PACE_LABELS[4]),
 		]
+# Profile field holding the user's speed (km/h) for each pace.
+PACE_FIELDS = {pace:f'pace_{i}' for i,pace in enumerate(PACES)}
 # Perceived difficulty of the activity, used in building schedule. Used by 
 # DB models and submission Form
 DIFF_CHOICES = [
@@ -50,8 +53,11 @@ DIFF_CHOICES = [
 WEEKS_CHOICES = [
 		(1,'1 Week'),
 		(2,'2 Weeks'),
+		(3,'3 Weeks'),
 		(4,'4 Weeks'),
-
+		(6,'6 Weeks'),
+		(8,'8 Weeks'),
+		(12,'12 Weeks'),
 		]	
 
 ### MODELS ###
@@ -62,18 +68,11 @@ class Profile(models.Model):
 	Stores information about user used to generate schedule and track
 	statistics. Any information not related to a specific activity saved here
 	"""
-	# Used to track date which corresponds to first day of shchedule where
-	# sch_length > 1. 
-	schedule_init_date = models.DateField(null=True,blank=True)
-	schedule_week = models.PositiveSmallIntegerField(default=0)
+	# Monday of the week in which week 1 of the user's plan began. Current 
+	# plan week is worked out from this and today's date.
+	plan_start_date = models.DateField(null=True,blank=True)
 	# User the profile is associated with.
-	owner = models.ForeignKey(User,on_delete=models.CASCADE)
-	# User's custom plan dict, maps activity id's to week day names.
-	plan = models.JSONField(null=True,blank=True)
-	# Activity history dictionary.
-	history = models.JSONField(null=True,blank=True)
-	# Mileage history
-	mileage_history = models.JSONField(null=True,blank=True)
+	owner = models.OneToOneField(User,on_delete=models.CASCADE)
 	# How many weeks the schedule will run for
 	plan_length = models.PositiveSmallIntegerField(
 		default=2,
@@ -87,14 +86,49 @@ class Profile(models.Model):
 	pace_4 = models.DecimalField(decimal_places=2,max_digits=4,default=13.5)
 	def user_pace(self,pace_value):
 		"""Give pace name, get speed for that user"""
-		paces = {
-			PACES[0]: self.pace_0,
-			PACES[1]: self.pace_1,
-			PACES[2]: self.pace_3,
-			PACES[3]: self.pace_3,
-			PACES[4]: self.pace_4,
-				}
-		return (paces[pace_value])		
+		return getattr(self,PACE_FIELDS[pace_value])
+
+	def pace_table(self):
+		"""Return dict mapping each pace name to user's speed for it."""
+		return {pace:getattr(self,field) for pace,field in PACE_FIELDS.items()}
+
+
+def estimate_distance(speed,minutes):
+	"""
+	Returns estimated distance in km covered in minutes at speed (km/h), 
+	rounded to the 2 decimal places stored on activities.
+	"""
+	return (Decimal(speed) * minutes / 60).quantize(Decimal('0.01'))
+
+
+class PlanSlot(models.Model):
+	"""
+	One day of a user's training plan. day_index counts days from 1 across all
+	weeks of the plan, activity is null for a rest day. A profile with no slots
+	has no plan.
+	"""
+	class Meta:
+		ordering = ['day_index']
+		constraints = [
+			models.UniqueConstraint(
+				fields=['profile','day_index'],
+				name='planslot_profile_day_unique',
+				),
+			]
+	profile = models.ForeignKey(
+		Profile,
+		on_delete=models.CASCADE,
+		related_name='plan_slots',
+		)
+	day_index = models.PositiveSmallIntegerField()
+	# Deleting an activity turns its plan days into rest days.
+	activity = models.ForeignKey(
+		'Activity',
+		on_delete=models.SET_NULL,
+		null=True,
+		blank=True,
+		related_name='plan_slots',
+		)
 
 
 class CompletedAct(models.Model):
@@ -103,6 +137,13 @@ class CompletedAct(models.Model):
 	"""
 	class Meta:
 		ordering = ['date_done']
+		# Completed acts are always looked up by owner and date range.
+		indexes = [
+			models.Index(
+				fields=['owner','date_done'],
+				name='completedact_owner_date_idx',
+				),
+			]
 	owner = models.ForeignKey(User, on_delete=models.CASCADE)	
 	date_done = models.DateField(null=True)
 	name = models.CharField(max_length=40,default='nameless')
@@ -112,6 +153,70 @@ class CompletedAct(models.Model):
 		null=True)
 			
 
+class ActivityLog(models.Model):
+	"""
+	One entry in a user's activity history. Entries are only ever appended,
+	and are read newest first a page at a time.
+	"""
+	class Meta:
+		ordering = ['-date','-id']
+		indexes = [
+			models.Index(
+				fields=['owner','-date','-id'],
+				name='activitylog_owner_date_idx',
+				),
+			]
+	owner = models.ForeignKey(User, on_delete=models.CASCADE)
+	date = models.DateField()
+	name = models.CharField(max_length=40,default='nameless')
+	# Null for activities without a distance.
+	distance = models.DecimalField(
+		max_digits=5,
+		decimal_places=2,
+		null=True,
+		blank=True)
+
+
+class WeeklyMileage(models.Model):
+	"""
+	Total distance covered by a user in the week beginning week_start 
+	(a Monday). Rows are updated in place as activities are submitted.
+	"""
+	class Meta:
+		ordering = ['-week_start']
+		constraints = [
+			models.UniqueConstraint(
+				fields=['owner','week_start'],
+				name='weeklymileage_owner_week_unique',
+				),
+			]
+	owner = models.ForeignKey(User, on_delete=models.CASCADE)
+	week_start = models.DateField()
+	distance = models.DecimalField(
+		max_digits=7,
+		decimal_places=2,
+		default=0)
+
+
+class SubclassIterable(ModelIterable):
+	"""Yields each Activity row as its concrete activity subclass."""
+	def __iter__(self):
+		for activity in super().__iter__():
+			yield activity.as_subclass()
+
+
+class ActivityQuerySet(models.QuerySet):
+	def select_subclasses(self):
+		"""
+		Return queryset which yields concrete activity types (PacedRun etc), 
+		joining all subclass tables so no extra query is needed per row.
+		"""
+		names = [model._meta.model_name for model in Activity.__subclasses__()]
+		queryset = self.select_related(*names)
+		queryset._iterable_class = SubclassIterable
+		return queryset
+
+
 # Parent class for all exercise types. All required fields / attributes here,
 # exercise-specific fields / attributes / methods go on exercise sub-classes.
 class Activity(models.Model):
@@ -122,6 +227,12 @@ class Activity(models.Model):
 	class Meta:
 		ordering = ['last_done']
 		# By default returns objects with oldest first
+		indexes = [
+			models.Index(
+				fields=['owner','last_done'],
+				name='activity_owner_last_done_idx',
+				),
+			]
 	# User readable description of the activity for display on home screen & schedule
 	name = models.CharField(max_length=40,default='nameless')
 	customname = models.CharField(max_length=40,blank=True,null=True)
@@ -146,9 +257,25 @@ class Activity(models.Model):
 	progressive = models.BooleanField(default=False)
 	# Used to store activity type in DB
 	my_type = models.CharField(max_length=20,default='')
+
+	objects = ActivityQuerySet.as_manager()
+
 	def __str__(self):
 		"""return string representation of the object"""
 		return self.name
+	def as_subclass(self):
+		"""
+		Return the concrete subclass instance for this activity, using the
+		instance loaded by select_subclasses if there is one. Returns self if
+		activity has no subclass row.
+		"""
+		for model in Activity.__subclasses__():
+			if model.act_type == self.my_type:
+				try:
+					return getattr(self,model._meta.model_name)
+				except model.DoesNotExist:
+					return self
+		return self
 	def update(self,post,date_done):
 		"""update values from submitted completion form data"""
 		self.difficulty = post.get('difficulty')
@@ -268,8 +395,10 @@ class PacedRun(Activity):
 		# Set estimated distance.
 		if self.prog_value == self.PROG_CHOICES[0][0]:#minutes
 			try:
-				dec_pace = profile.user_pace(self.pace)
-				self.distance = dec_pace * Decimal(self.minutes / 60)
+				self.distance = estimate_distance(
+					profile.user_pace(self.pace),
+					self.minutes,
+					)
 			except:
 				self.distance = 0.0
 		return self	
@@ -353,7 +482,8 @@ class TimeTrial(Activity):
 		minutes = int(post.get('minutes') or 0)
 		seconds = int(post.get('seconds') or 0)
 		time = (minutes * 60) + seconds
-		if self.best and self.best <= time:
+		# No time entered, e.g. when submitted without details, keeps PB.
+		if not time or (self.best and self.best <= time):
 			return self
 		else:
 			self.best = time 
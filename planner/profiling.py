@@ -0,0 +1,143 @@
+"""
+Profiling of sampled requests in production.
+
+ProfilingMiddleware (in planner.middleware) profiles a fraction of requests,
+settings.PROFILE_SAMPLE_RATE, and any request by a staff user sending the
+settings.PROFILE_HEADER header. Requests are profiled with pyinstrument's
+stack sampler if it is installed, otherwise with cProfile.
+
+Each profiled request is saved to settings.PROFILE_DIR as a dump (.prof for
+cProfile, open with pstats or snakeviz, .html for pyinstrument) and a .json
+summary with the request, its duration and the planner.views functions with
+most cumulative time. Only the newest settings.PROFILE_KEEP are kept. The
+staff only profiles view lists the slowest of them.
+"""
+from django.conf import settings
+from pathlib import Path
+import cProfile
+import json
+import os
+import pstats
+import tempfile
+import time
+import uuid
+
+try:
+	import pyinstrument
+except ImportError:
+	pyinstrument = None
+
+# Number of planner.views functions listed for each request.
+TOP_FUNCTIONS = 10
+VIEWS_FILE = os.path.realpath(Path(__file__).with_name('views.py'))
+
+
+def profile_dir():
+	return Path(getattr(settings,'PROFILE_DIR',
+		Path(tempfile.gettempdir()) / 'planner-profiles'))
+
+
+class RequestProfiler:
+	"""Profiles the code run inside it, then saves the dump and summary."""
+	def __init__(self):
+		if pyinstrument:
+			self.profiler = pyinstrument.Profiler()
+			self.kind = 'pyinstrument'
+		else:
+			self.profiler = cProfile.Profile()
+			self.kind = 'cProfile'
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		if pyinstrument:
+			self.profiler.start()
+		else:
+			self.profiler.enable()
+		return self
+
+	def __exit__(self,*exc_info):
+		if pyinstrument:
+			self.profiler.stop()
+		else:
+			self.profiler.disable()
+		self.seconds = time.perf_counter() - self.start
+
+	def save(self,request,response):
+		"""Write dump and summary of the profiled request, return summary."""
+		directory = profile_dir()
+		directory.mkdir(parents=True,exist_ok=True)
+		# Names sort in the order requests were profiled.
+		name = f'{time.time_ns()}-{uuid.uuid4().hex[:8]}'
+		if pyinstrument:
+			dump = directory / f'{name}.html'
+			dump.write_text(self.profiler.output_html())
+		else:
+			dump = directory / f'{name}.prof'
+			self.profiler.dump_stats(dump)
+		match = request.resolver_match
+		summary = {
+			'name':name,
+			'dump':dump.name,
+			'profiler':self.kind,
+			'time':time.time(),
+			'method':request.method,
+			'path':request.path,
+			'view':match.view_name if match else None,
+			'user_id':request.user.id,
+			'status':response.status_code,
+			'ms':round(self.seconds * 1000,2),
+			'functions':self.top_functions(),
+			}
+		(directory / f'{name}.json').write_text(json.dumps(summary))
+		rotate(directory)
+		return summary
+
+	def top_functions(self):
+		"""
+		Return list of (function, cumulative ms, calls) for planner.views
+		functions, most cumulative time first.
+		"""
+		if pyinstrument:
+			functions = {}
+			frames = [self.profiler.last_session.root_frame()]
+			while frames:
+				frame = frames.pop()
+				frames += frame.children
+				if frame.file_path and os.path.realpath(frame.file_path) == VIEWS_FILE:
+					seconds,calls = functions.get(frame.function,(0,0))
+					functions[frame.function] = (seconds + frame.time,calls + 1)
+			functions = [
+				(function,round(seconds * 1000,2),calls)
+				for function,(seconds,calls) in functions.items()
+				]
+		else:
+			stats = pstats.Stats(self.profiler).stats
+			functions = [
+				(f'{function} (line {line})',round(cumulative * 1000,2),calls)
+				for (path,line,function),(_,calls,_,cumulative,_) in stats.items()
+				if os.path.realpath(path) == VIEWS_FILE
+				]
+		functions.sort(key=lambda function: function[1],reverse=True)
+		return functions[:TOP_FUNCTIONS]
+
+
+def rotate(directory):
+	"""Delete all but the newest PROFILE_KEEP profiled requests."""
+	keep = getattr(settings,'PROFILE_KEEP',50)
+	summaries = sorted(directory.glob('*.json'))
+	for summary in summaries[:max(len(summaries) - keep,0)]:
+		for path in directory.glob(f'{summary.stem}.*'):
+			path.unlink(missing_ok=True)
+
+
+def slowest(limit=20):
+	"""Return summaries of the slowest saved requests, slowest first."""
+	summaries = []
+	for path in profile_dir().glob('*.json'):
+		try:
+			summaries.append(json.loads(path.read_text()))
+		except (OSError,ValueError):
+			# Deleted by another process rotating the directory.
+			continue
+	summaries.sort(key=lambda summary: summary['ms'],reverse=True)
+	return summaries[:limit]
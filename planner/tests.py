@@ -1,3 +1,1058 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, AsyncRequestFactory, override_settings
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.contrib.auth.models import User, AnonymousUser
+from django.urls import reverse
+from django.http import HttpResponse
+from datetime import date, timedelta
+from decimal import Decimal
+from io import StringIO
+from pathlib import Path
+from unittest import mock
+import json
+import os
+import tempfile
+import time
 
-# Create your tests here.
+from .models import (Activity, PacedRun, Intervals, CrossTrain, Profile, PACES,
+	CompletedAct, ActivityLog, WeeklyMileage, PlanSlot)
+from . import caching, instrumentation, metrics, views
+from .views import (get_initial_date, save_completion, get_schedule_list, update_mileage,
+	get_schedule_position, Day, HISTORY_PAGE_SIZE, PLAN_DAYS, dateFormat)
+
+
+def make_plan(profile,act_ids):
+	"""Saves 2 week plan for profile using act_ids in order"""
+	PlanSlot.objects.bulk_create([
+		PlanSlot(profile=profile,day_index=i + 1,activity_id=act_ids[i % len(act_ids)])
+		for i in range(14)
+		])
+
+
+class PlannedUserMixin:
+	"""
+	Logged in user with a 2 week plan of one activity, self.act, starting
+	this week. Days of this week already passed are done, so home shows the
+	schedule. Caches are cleared first.
+	"""
+	def setUp(self):
+		super().setUp()
+		cache.clear()
+		self.user = User.objects.create_user('runner',password='pw')
+		self.act = CrossTrain(owner=self.user,exercise_type='Swim')
+		self.act.setvalues()
+		self.act.save()
+		self.profile = Profile.objects.create(owner=self.user,
+			plan_start_date=get_initial_date(date.today()))
+		make_plan(self.profile,[self.act.id])
+		CompletedAct.objects.bulk_create([
+			CompletedAct(owner=self.user,date_done=day,name='Done')
+			for day in (self.profile.plan_start_date + timedelta(days=i) for i in range(7))
+			if day < date.today()
+			])
+		self.client.force_login(self.user)
+
+
+class HomeQueryCountTests(PlannedUserMixin,TestCase):
+	"""Home page should cost the same number of queries for any plan."""
+	def set_plan(self,n_activities):
+		PlanSlot.objects.filter(profile=self.profile).delete()
+		acts = []
+		for i in range(n_activities):
+			act = CrossTrain(owner=self.user,exercise_type=f'Swim {i}')
+			act.setvalues()
+			act.save()
+			acts.append(act.id)
+		make_plan(self.profile,acts)
+
+	def test_single_activity_plan(self):
+		self.set_plan(1)
+		with self.assertNumQueries(5):
+			response = self.client.get(reverse('planner:home'))
+		self.assertContains(response,'Swim 0')
+
+	def test_many_activity_plan(self):
+		self.set_plan(14)
+		with self.assertNumQueries(5):
+			response = self.client.get(reverse('planner:home'))
+		self.assertContains(response,'Swim 13')
+
+	@override_settings(PROFILE_SELECT_USER=False)
+	def test_separate_user_query(self):
+		self.set_plan(14)
+		with self.assertNumQueries(6):
+			self.client.get(reverse('planner:home'))
+
+
+class ScheduleOverlayTests(TestCase):
+	"""Completed activities replace scheduled days by exact date."""
+	def setUp(self):
+		self.user = User.objects.create_user('runner',password='pw')
+		self.act = CrossTrain(owner=self.user,exercise_type='Swim')
+		self.act.setvalues()
+		self.act.save()
+		self.profile = Profile.objects.create(
+			owner=self.user,
+			plan_start_date=get_initial_date(date.today()),
+			)
+		make_plan(self.profile,[self.act.id])
+
+	def test_completed_day_replaced(self):
+		tomorrow = date.today() + timedelta(days=1)
+		CompletedAct.objects.create(owner=self.user,date_done=tomorrow,name='Bike')
+		schedule = get_schedule_list(self.profile)
+		day = [day for day in schedule if day.day_date == tomorrow][0]
+		self.assertTrue(day.complete)
+		self.assertEqual(day.name,'Bike')
+
+	def test_same_day_other_year_ignored(self):
+		# Find an earlier year where tomorrow's date falls on the same weekday,
+		# so the two dates have the same "%a %d %b" string.
+		tomorrow = date.today() + timedelta(days=1)
+		for years in range(1,12):
+			try:
+				old_date = tomorrow.replace(year=tomorrow.year - years)
+			except ValueError:
+				continue
+			if old_date.weekday() == tomorrow.weekday():
+				break
+		CompletedAct.objects.create(owner=self.user,date_done=old_date,name='Bike')
+		schedule = get_schedule_list(self.profile)
+		day = [day for day in schedule if day.day_date == tomorrow][0]
+		self.assertFalse(day.complete)
+		self.assertEqual(day.name,'Swim')
+
+
+class PurgeCompletedTests(TestCase):
+	"""Old completed acts are purged for all users in batches."""
+	def test_purge_completed(self):
+		today = date.today()
+		for i in range(3):
+			user = User.objects.create_user(f'runner{i}',password='pw')
+			CompletedAct.objects.create(owner=user,date_done=today,name='New')
+			CompletedAct.objects.create(
+				owner=user,
+				date_done=today - timedelta(days=40),
+				name='Old',
+				)
+		out = StringIO()
+		call_command('purge_completed','--batch','2',stdout=out)
+		self.assertIn('Deleted 3',out.getvalue())
+		self.assertFalse(CompletedAct.objects.filter(name='Old').exists())
+		self.assertEqual(CompletedAct.objects.filter(name='New').count(),3)
+
+
+class HistoryPaginationTests(TestCase):
+	"""History pages follow on from the last entry of the previous page."""
+	def setUp(self):
+		self.user = User.objects.create_user('runner',password='pw')
+		self.client.force_login(self.user)
+		start = date(2020,1,1)
+		# Two entries per day, so pages split entries sharing a date.
+		ActivityLog.objects.bulk_create([
+			ActivityLog(
+				owner=self.user,
+				date=start + timedelta(days=i // 2),
+				name=f'Run {i}',
+				)
+			for i in range(HISTORY_PAGE_SIZE * 2 + 5)
+			])
+
+	def test_pages_cover_history_once(self):
+		seen = []
+		url = reverse('planner:history')
+		while url:
+			response = self.client.get(url)
+			seen += [entry.name for entry in response.context['history_list']]
+			next_page = response.context.get('next_page')
+			url = next_page and f"{reverse('planner:history')}?before={next_page}"
+		self.assertEqual(len(seen),HISTORY_PAGE_SIZE * 2 + 5)
+		self.assertEqual(len(set(seen)),len(seen))
+		self.assertEqual(seen[0],f'Run {HISTORY_PAGE_SIZE * 2 + 4}')
+
+	def test_bad_cursor(self):
+		response = self.client.get(reverse('planner:history') + '?before=junk')
+		self.assertEqual(response.status_code,404)
+
+
+class WeeklyMileageTests(TestCase):
+	"""Distances are added to the total for the week they were done in."""
+	def setUp(self):
+		self.user = User.objects.create_user('runner',password='pw')
+
+	def test_same_week_adds_up(self):
+		update_mileage(self.user,date(2022,5,2),Decimal('5.5'))
+		update_mileage(self.user,date(2022,5,8),Decimal('4.5'))
+		week = WeeklyMileage.objects.get(owner=self.user)
+		self.assertEqual(week.week_start,date(2022,5,2))
+		self.assertEqual(week.distance,Decimal('10'))
+
+	def test_backdated_week(self):
+		update_mileage(self.user,date(2022,5,10),Decimal('5'))
+		update_mileage(self.user,date(2022,5,3),Decimal('3'))
+		weeks = WeeklyMileage.objects.filter(owner=self.user)
+		self.assertEqual(
+			[(week.week_start,week.distance) for week in weeks],
+			[(date(2022,5,9),Decimal('5')),(date(2022,5,2),Decimal('3'))],
+			)
+
+	def test_no_distance(self):
+		update_mileage(self.user,date(2022,5,2),0)
+		self.assertFalse(WeeklyMileage.objects.exists())
+
+
+class SelectSubclassesTests(TestCase):
+	"""Activities load as their concrete type in one query."""
+	def setUp(self):
+		self.user = User.objects.create_user('runner',password='pw')
+		self.profile = Profile.objects.create(owner=self.user)
+		self.run = PacedRun(owner=self.user,minutes=30)
+		self.run.setvalues(self.profile)
+		self.run.save()
+		self.intervals = Intervals(owner=self.user,rep_length=400,rep_number=6)
+		self.intervals.setvalues()
+		self.intervals.save()
+
+	def test_mixed_list(self):
+		with self.assertNumQueries(1):
+			activities = list(
+				Activity.objects.filter(owner=self.user).select_subclasses())
+			types = {type(act) for act in activities}
+			self.assertEqual(types,{PacedRun,Intervals})
+			run = [act for act in activities if isinstance(act,PacedRun)][0]
+			self.assertEqual(run.minutes,30)
+			self.assertEqual(run.name,'30 minute Moderate Run')
+			self.assertEqual(run.owner_id,self.user.id)
+
+	def test_submit_progresses_activity(self):
+		self.intervals.progressive = True
+		self.intervals.rep_goal = 10
+		self.intervals.save()
+		self.client.force_login(self.user)
+		url = reverse(
+			'planner:submitdate',
+			args=[self.intervals.id,date.today().isoformat()])
+		response = self.client.post(url,{
+			'act_id':self.intervals.id,
+			'difficulty':'2',
+			'completed':'on',
+			})
+		self.assertEqual(response.status_code,302)
+		intervals = Intervals.objects.get(id=self.intervals.id)
+		self.assertEqual(intervals.rep_number,7)
+		self.assertEqual(intervals.name,'7 x 400 m Intervals')
+		self.assertTrue(CompletedAct.objects.filter(owner=self.user).exists())
+
+	def test_other_users_activity(self):
+		other = User.objects.create_user('other',password='pw')
+		self.client.force_login(other)
+		response = self.client.get(reverse('planner:edit',args=[self.run.id]))
+		self.assertEqual(response.status_code,404)
+
+
+class ScheduleCacheTests(PlannedUserMixin,TestCase):
+	"""Home page schedule is cached until something changes it."""
+	def get_today(self):
+		response = self.client.get(reverse('planner:home'))
+		schedule = response.context['schedule_list']
+		return [day for day in schedule if day.date_str == 'Today'][0]
+
+	def check_cache(self):
+		stats = caching.schedule_cache_stats()
+		self.assertEqual(self.get_today().name,'Swim')
+		self.assertEqual(self.get_today().name,'Swim')
+		new_stats = caching.schedule_cache_stats()
+		self.assertEqual(new_stats['misses'] - stats['misses'],1)
+		self.assertEqual(new_stats['hits'] - stats['hits'],1)
+		# Submitting rest day for today must invalidate cached schedule.
+		self.client.get(
+			reverse('planner:restdate',args=[date.today().isoformat()]))
+		self.assertEqual(self.get_today().name,'Rest Day')
+
+	def test_local_memory_cache(self):
+		self.check_cache()
+
+	def test_file_cache(self):
+		with tempfile.TemporaryDirectory() as cache_dir:
+			with override_settings(CACHES={'default':{
+				'BACKEND':'django.core.cache.backends.filebased.FileBasedCache',
+				'LOCATION':cache_dir,
+				}}):
+				self.check_cache()
+
+
+class PlanRotationTests(TestCase):
+	"""Schedule shows current plan week followed by the next one."""
+	def test_plan_days(self):
+		a = (1,2,3,4,5,6,7)
+		b = (8,9,10,11,12,13,14)
+		c = (15,16,17,18,19,20,21)
+		d = (22,23,24,25,26,27,28)
+		self.assertEqual(PLAN_DAYS[(1,0)],a + a)
+		self.assertEqual(PLAN_DAYS[(2,0)],a + b)
+		self.assertEqual(PLAN_DAYS[(2,1)],b + a)
+		self.assertEqual(PLAN_DAYS[(4,1)],b + c)
+		self.assertEqual(PLAN_DAYS[(4,3)],d + a)
+		self.assertEqual(PLAN_DAYS[(3,2)],c + a)
+		self.assertEqual(PLAN_DAYS[(12,11)][:7],tuple(range(78,85)))
+
+	def test_day_date_string(self):
+		start = date(2022,1,3)
+		for i in range(400):
+			day_date = start + timedelta(days=i)
+			day = Day(day_date,today=start)
+			if day_date != start:
+				self.assertEqual(day.date_str,day_date.strftime(dateFormat))
+		self.assertEqual(Day(start,today=start).date_str,'Today')
+
+
+class SchedulePositionTests(TestCase):
+	"""Plan week follows from plan start date without saving anything."""
+	def test_position(self):
+		start = date(2022,1,3)
+		self.assertEqual(get_schedule_position(start,start,4),(start,0))
+		self.assertEqual(
+			get_schedule_position(start,date(2022,1,9),4),(start,0))
+		self.assertEqual(
+			get_schedule_position(start,date(2022,1,10),4),(date(2022,1,10),1))
+		# Several weeks away still gives the right week.
+		self.assertEqual(
+			get_schedule_position(start,date(2022,2,23),4),(date(2022,2,21),3))
+		self.assertEqual(
+			get_schedule_position(start,date(2022,2,28),4),(date(2022,2,28),0))
+		self.assertEqual(
+			get_schedule_position(start,date(2022,2,28),3),(date(2022,2,28),2))
+
+	def test_home_does_not_write(self):
+		cache.clear()
+		user = User.objects.create_user('runner',password='pw')
+		act = CrossTrain(owner=user,exercise_type='Swim')
+		act.setvalues()
+		act.save()
+		profile = Profile.objects.create(
+			owner=user,
+			plan_start_date=date.today() - timedelta(weeks=9),
+			)
+		make_plan(profile,[act.id])
+		self.client.force_login(user)
+		with CaptureQueriesContext(connection) as queries:
+			self.client.get(reverse('planner:home'))
+		writes = [query['sql'] for query in queries.captured_queries
+			if not query['sql'].startswith('SELECT')]
+		self.assertEqual(writes,[])
+
+
+class ProfileMiddlewareTests(TestCase):
+	"""request.profile is created once and loaded at most once per request."""
+	def setUp(self):
+		self.user = User.objects.create_user('runner',password='pw')
+		self.client.force_login(self.user)
+
+	def test_profile_created(self):
+		self.client.get(reverse('planner:settings'))
+		self.client.get(reverse('planner:settings'))
+		self.assertEqual(Profile.objects.filter(owner=self.user).count(),1)
+
+	def test_missing_profile_selected_once(self):
+		with CaptureQueriesContext(connection) as queries:
+			self.client.get(reverse('planner:settings'))
+		profile_selects = [query for query in queries.captured_queries
+			if query['sql'].startswith('SELECT') and 'FROM "planner_profile"' in query['sql']]
+		# The joined select with the session user, then one after it is missing.
+		self.assertEqual(len(profile_selects),2)
+
+	def test_inactive_user(self):
+		Profile.objects.create(owner=self.user)
+		self.user.is_active = False
+		self.user.save()
+		response = self.client.get(reverse('planner:settings'))
+		self.assertEqual(response.status_code,302)
+
+	def test_changed_password_logs_out(self):
+		Profile.objects.create(owner=self.user)
+		self.user.set_password('new')
+		self.user.save()
+		response = self.client.get(reverse('planner:settings'))
+		self.assertEqual(response.status_code,302)
+
+
+class SaveCompletionTests(TestCase):
+	"""Submitting writes only changed activity columns, in one transaction."""
+	def setUp(self):
+		self.user = User.objects.create_user('runner',password='pw')
+		self.profile = Profile.objects.create(owner=self.user)
+		self.act = Intervals(
+			owner=self.user,
+			rep_length=400,
+			rep_number=6,
+			progressive=True,
+			rep_goal=10,
+			)
+		self.act.setvalues()
+		self.act.save()
+
+	def test_only_changed_columns_written(self):
+		post = {'difficulty':'3','completed':'on'}
+		with CaptureQueriesContext(connection) as queries:
+			save_completion(self.user,date.today(),self.act,post,self.profile)
+		updates = [query['sql'] for query in queries.captured_queries
+			if query['sql'].startswith('UPDATE "planner_activity"')]
+		self.assertEqual(len(updates),1)
+		self.assertNotIn('"owner_id" =',updates[0].split('WHERE')[0])
+		self.assertIn('"difficulty" =',updates[0])
+		act = Intervals.objects.get(id=self.act.id)
+		self.assertEqual(act.rep_number,7)
+		self.assertEqual(act.difficulty,'3')
+		log = ActivityLog.objects.get(owner=self.user)
+		self.assertEqual(log.name,'6 x 400 m Intervals')
+
+	def test_rest_day(self):
+		save_completion(self.user,date.today())
+		completed = CompletedAct.objects.get(owner=self.user)
+		self.assertEqual(completed.name,'Rest Day')
+		self.assertFalse(ActivityLog.objects.exists())
+
+
+class CatchupTests(TestCase):
+	"""Missed days are all saved from one request, in a fixed number of queries."""
+	def setUp(self):
+		self.user = User.objects.create_user('runner',password='pw')
+		self.profile = Profile.objects.create(owner=self.user)
+		self.act = Intervals(
+			owner=self.user,
+			rep_length=400,
+			rep_number=6,
+			progressive=True,
+			rep_goal=20,
+			)
+		self.act.setvalues()
+		self.act.save()
+		self.client.login(username='runner',password='pw')
+		self.monday = get_initial_date(date.today()) - timedelta(days=7)
+
+	def post_days(self,count):
+		data = {'date_iso':[]}
+		for i in range(count):
+			date_iso = (self.monday + timedelta(days=i)).isoformat()
+			data['date_iso'].append(date_iso)
+			if i % 3 == 2:
+				data[f'status_{date_iso}'] = 'missed'
+			else:
+				data[f'status_{date_iso}'] = 'done'
+				data[f'act_{date_iso}'] = str(self.act.id)
+				data[f'difficulty_{date_iso}'] = '1'
+				data[f'completed_{date_iso}'] = 'on'
+		with CaptureQueriesContext(connection) as queries:
+			response = self.client.post(reverse('planner:catchup'),data)
+		self.assertRedirects(response,reverse('planner:home'),
+			fetch_redirect_response=False)
+		return len(queries.captured_queries)
+
+	def test_constant_queries(self):
+		# First request also creates the week's mileage row.
+		self.post_days(1)
+		self.assertEqual(self.post_days(6),self.post_days(2))
+
+	def test_days_saved_in_order(self):
+		self.post_days(3)
+		self.assertEqual(CompletedAct.objects.filter(owner=self.user).count(),3)
+		self.assertEqual(
+			list(ActivityLog.objects.filter(owner=self.user)
+				.order_by('date').values_list('name',flat=True)),
+			['6 x 400 m Intervals','7 x 400 m Intervals'],
+			)
+		act = Intervals.objects.get(id=self.act.id)
+		self.assertEqual(act.rep_number,8)
+		self.assertEqual(act.last_done,self.monday + timedelta(days=1))
+
+	def test_other_users_activity(self):
+		other = User.objects.create_user('other',password='pw')
+		self.act.owner = other
+		self.act.save()
+		date_iso = self.monday.isoformat()
+		response = self.client.post(reverse('planner:catchup'),{
+			'date_iso':date_iso,
+			f'status_{date_iso}':'done',
+			f'act_{date_iso}':str(self.act.id),
+			})
+		self.assertEqual(response.status_code,404)
+		self.assertFalse(CompletedAct.objects.exists())
+
+
+class PlanSlotTests(TestCase):
+	"""Plans are saved one slot per day, with activities kept consistent."""
+	def setUp(self):
+		cache.clear()
+		self.user = User.objects.create_user('runner',password='pw')
+		self.profile = Profile.objects.create(owner=self.user,plan_length=1)
+		self.act = CrossTrain(owner=self.user,exercise_type='Swim')
+		self.act.setvalues()
+		self.act.save()
+		self.client.force_login(self.user)
+
+	def test_generate_plan_saves_slots(self):
+		other = User.objects.create_user('other',password='pw')
+		other_act = CrossTrain.objects.create(owner=other,exercise_type='Bike')
+		data = {f'day_{i + 1}':'REST' for i in range(7)}
+		data['day_1'] = str(self.act.id)
+		data['day_2'] = str(other_act.id)
+		self.client.post(reverse('planner:generate'),data)
+		slots = list(PlanSlot.objects.filter(profile=self.profile))
+		self.assertEqual([slot.day_index for slot in slots],list(range(1,8)))
+		self.assertEqual(slots[0].activity_id,self.act.id)
+		# Other user's activity is saved as a rest day.
+		self.assertIsNone(slots[1].activity_id)
+		self.profile.refresh_from_db()
+		self.assertIsNotNone(self.profile.plan_start_date)
+
+	def test_reset_plan(self):
+		self.profile.plan_start_date = get_initial_date(date.today())
+		self.profile.save()
+		make_plan(self.profile,[self.act.id])
+		self.client.get(reverse('planner:reset',args=['plan','delete']))
+		self.profile.refresh_from_db()
+		self.assertIsNone(self.profile.plan_start_date)
+		self.assertFalse(PlanSlot.objects.filter(profile=self.profile).exists())
+
+	def test_deleted_activity_becomes_rest_day(self):
+		self.profile.plan_start_date = get_initial_date(date.today())
+		self.profile.save()
+		make_plan(self.profile,[self.act.id])
+		self.act.delete()
+		self.assertFalse(PlanSlot.objects.exclude(activity=None).exists())
+		schedule = get_schedule_list(self.profile)
+		self.assertEqual({day.name for day in schedule},{'Rest Day'})
+
+	def test_no_slots_no_plan(self):
+		self.profile.plan_start_date = get_initial_date(date.today())
+		self.profile.save()
+		self.assertEqual(get_schedule_list(self.profile),[])
+		response = self.client.get(reverse('planner:home'))
+		self.assertContains(response,'create activities/ plan')
+
+
+class PaceSettingsTests(TestCase):
+	"""Saving paces re-estimates distances of all time based runs at once."""
+	def setUp(self):
+		self.user = User.objects.create_user('runner',password='pw')
+		self.profile = Profile.objects.create(owner=self.user)
+		self.client.force_login(self.user)
+
+	def make_runs(self,count,pace=PACES[2]):
+		for i in range(count):
+			run = PacedRun(owner=self.user,minutes=30 + i,pace=pace)
+			run.setvalues(self.profile)
+			run.save()
+
+	def post_paces(self,**paces):
+		data = {f'pace_{i}':str(getattr(self.profile,f'pace_{i}')) for i in range(5)}
+		data.update(paces)
+		with CaptureQueriesContext(connection) as queries:
+			self.client.post(reverse('planner:savepacesettings'),data)
+		return len(queries.captured_queries)
+
+	def test_moderate_run_uses_its_own_pace(self):
+		self.profile.pace_2 = Decimal('10')
+		self.assertEqual(self.profile.user_pace(PACES[2]),Decimal('10'))
+		self.make_runs(1)
+		self.assertEqual(PacedRun.objects.get().distance,Decimal('5.00'))
+
+	def test_distances_recomputed(self):
+		self.make_runs(3)
+		self.make_runs(1,pace=PACES[0])
+		self.post_paces(pace_2='12')
+		distances = sorted(PacedRun.objects.filter(pace=PACES[2])
+			.values_list('distance',flat=True))
+		self.assertEqual(distances,[Decimal('6.00'),Decimal('6.20'),Decimal('6.40')])
+		# Walk pace unchanged, so walk is not rewritten.
+		self.assertEqual(PacedRun.objects.get(pace=PACES[0]).distance,Decimal('3.25'))
+
+	def test_legacy_pace_kept(self):
+		# Paces from old choices, e.g. 'HARD', are not in the pace table.
+		self.make_runs(1)
+		PacedRun.objects.update(pace='HARD')
+		distance = PacedRun.objects.get().distance
+		self.post_paces(pace_2='12')
+		self.assertEqual(PacedRun.objects.get().distance,distance)
+		self.profile.refresh_from_db()
+		self.assertEqual(self.profile.pace_2,Decimal('12'))
+
+	def test_constant_queries(self):
+		self.make_runs(2)
+		few = self.post_paces(pace_2='12')
+		PacedRun.objects.all().delete()
+		self.make_runs(40)
+		self.assertEqual(self.post_paces(pace_2='11'),few)
+
+
+class ExportTests(TestCase):
+	"""Exports stream only the user's own rows, as CSV or NDJSON."""
+	def setUp(self):
+		self.user = User.objects.create_user('runner',password='pw')
+		other = User.objects.create_user('other',password='pw')
+		ActivityLog.objects.create(owner=self.user,date=date(2022,3,1),
+			name='Swim',distance=None)
+		ActivityLog.objects.create(owner=self.user,date=date(2022,3,2),
+			name='Run, easy',distance=Decimal('5.25'))
+		ActivityLog.objects.create(owner=other,date=date(2022,3,2),name='Bike')
+		self.client.force_login(self.user)
+
+	def get_export(self,dataset,fmt):
+		response = self.client.get(reverse('planner:export',args=[dataset,fmt]))
+		self.assertTrue(response.streaming)
+		return b''.join(response.streaming_content).decode()
+
+	def test_csv(self):
+		self.assertEqual(
+			self.get_export('history','csv').splitlines(),
+			['date,name,distance','2022-03-02,"Run, easy",5.25','2022-03-01,Swim,'],
+			)
+
+	def test_ndjson(self):
+		rows = [json.loads(line) for line in self.get_export('history','ndjson').splitlines()]
+		self.assertEqual(rows,[
+			{'date':'2022-03-02','name':'Run, easy','distance':5.25},
+			{'date':'2022-03-01','name':'Swim','distance':None},
+			])
+
+	def test_unknown_export(self):
+		response = self.client.get(reverse('planner:export',args=['profile','csv']))
+		self.assertEqual(response.status_code,404)
+
+
+GPX = """<?xml version="1.0"?>
+<gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1">
+  <metadata><time>2022-01-01T00:00:00Z</time></metadata>
+  <trk><name>Park loop</name><trkseg>
+    <trkpt lat="51.5000" lon="-0.1000"><time>2022-03-07T07:00:00Z</time></trkpt>
+    <trkpt lat="51.5090" lon="-0.1000"><time>2022-03-07T07:05:00Z</time></trkpt>
+  </trkseg></trk>
+</gpx>"""
+
+
+class ImportTests(TestCase):
+	"""CSV and GPX files are imported in batches, in one transaction."""
+	def setUp(self):
+		self.user = User.objects.create_user('runner',password='pw')
+		self.dir = tempfile.TemporaryDirectory()
+		self.addCleanup(self.dir.cleanup)
+
+	def write(self,name,content):
+		path = f'{self.dir.name}/{name}'
+		with open(path,'w') as file:
+			file.write(content)
+		return path
+
+	def test_csv_command(self):
+		WeeklyMileage.objects.create(owner=self.user,week_start=date(2022,3,7),
+			distance=Decimal('10'))
+		path = self.write('runs.csv',
+			'date,name,distance\n'
+			'2022-03-07,Easy run,5.5\n'
+			'2022-03-09,Swim,\n'
+			'2022-03-14,Long run,21.1\n'
+			)
+		out = StringIO()
+		call_command('import_activities','runner',path,'--batch','2',stdout=out)
+		self.assertIn('Imported 3 activities over 2 weeks',out.getvalue())
+		self.assertEqual(CompletedAct.objects.filter(owner=self.user).count(),3)
+		self.assertEqual(ActivityLog.objects.get(name='Swim').distance,None)
+		self.assertEqual(
+			list(WeeklyMileage.objects.filter(owner=self.user)
+				.values_list('week_start','distance')),
+			[(date(2022,3,14),Decimal('21.10')),(date(2022,3,7),Decimal('15.50'))],
+			)
+
+	def test_week_created_concurrently(self):
+		WeeklyMileage.objects.create(owner=self.user,week_start=date(2022,3,7),
+			distance=Decimal('2'))
+		path = self.write('runs.csv','date,name,distance\n2022-03-09,Easy run,5.5\n')
+		# As if update_mileage created the week after existing weeks were read.
+		with mock.patch.object(WeeklyMileage.objects,'select_for_update',
+				return_value=WeeklyMileage.objects.none()):
+			call_command('import_activities','runner',path,stdout=StringIO())
+		self.assertEqual(WeeklyMileage.objects.get(owner=self.user).distance,Decimal('7.50'))
+
+	def test_bad_row_imports_nothing(self):
+		path = self.write('runs.csv','date,name,distance\n2022-03-07,Run,5\njunk,Run,5\n')
+		with self.assertRaisesMessage(CommandError,'runs.csv line 3'):
+			call_command('import_activities','runner',path,'--batch','1')
+		self.assertFalse(ActivityLog.objects.exists())
+
+	def test_gpx_parallel(self):
+		paths = [self.write(f'track{i}.gpx',GPX) for i in range(2)]
+		call_command('import_activities','runner',*paths,'--jobs','2',stdout=StringIO())
+		logs = list(ActivityLog.objects.filter(owner=self.user))
+		self.assertEqual(len(logs),2)
+		self.assertEqual(logs[0].name,'Park loop')
+		self.assertEqual(logs[0].date,date(2022,3,7))
+		# 0.009 degrees of latitude is just over 1 km.
+		self.assertEqual(logs[0].distance,Decimal('1.00'))
+
+	def test_upload(self):
+		self.client.force_login(self.user)
+		upload = SimpleUploadedFile('runs.csv',b'date,name,distance\n2022-03-07,Run,5\n')
+		response = self.client.post(reverse('planner:import'),{'files':upload})
+		self.assertContains(response,'Imported 1 activities.')
+		self.assertEqual(WeeklyMileage.objects.get(owner=self.user).distance,Decimal('5'))
+
+	def test_upload_not_utf8(self):
+		self.client.force_login(self.user)
+		upload = SimpleUploadedFile('runs.csv',
+			'date,name,distance\n2022-03-07,Café run,5\n'.encode('latin-1'))
+		response = self.client.post(reverse('planner:import'),{'files':upload})
+		self.assertContains(response,'runs.csv: not a UTF-8 text file')
+		self.assertFalse(ActivityLog.objects.exists())
+
+
+class SeedLoadTests(TestCase):
+	"""Seeded data is reproducible and usable by the views."""
+	def seed(self,**options):
+		call_command('seed_load',users=3,years=0.2,seed=5,end=date(2022,3,6),
+			stdout=StringIO(),**options)
+		return list(ActivityLog.objects.order_by('owner__username','id')
+			.values_list('owner__username','date','name','distance'))
+
+	def test_reproducible(self):
+		first = self.seed()
+		self.assertTrue(first)
+		self.assertEqual(self.seed(clear=True),first)
+
+	def test_views_use_seeded_rows(self):
+		self.seed()
+		user = User.objects.get(username='load_0')
+		activities = list(Activity.objects.filter(owner=user).select_subclasses())
+		self.assertTrue(activities)
+		self.assertNotIn(Activity,{type(activity) for activity in activities})
+		self.assertTrue(PlanSlot.objects.filter(profile__owner=user).exists())
+		self.assertTrue(self.client.login(username='load_0',password='load'))
+		self.assertEqual(self.client.get(reverse('planner:home')).status_code,200)
+
+
+class BenchViewsTests(TestCase):
+	"""View benchmark writes results and fails on regressions."""
+	def test_baseline_regression(self):
+		with tempfile.TemporaryDirectory() as directory:
+			output = f'{directory}/results.json'
+			call_command('bench_views',sizes='2',years=0.1,runs=2,output=output,
+				stdout=StringIO())
+			with open(output) as file:
+				report = json.load(file)
+			home = report['results']['2']['home']
+			self.assertGreater(home['queries'],0)
+			self.assertLessEqual(home['p50_ms'],home['p99_ms'])
+			home['queries'] -= 1
+			with open(output,'w') as file:
+				json.dump(report,file)
+			with self.assertRaisesMessage(CommandError,'2 users home queries'):
+				call_command('bench_views',sizes='2',years=0.1,runs=2,
+					output=f'{directory}/new.json',baseline=output,stdout=StringIO())
+
+
+class TimingMiddlewareTests(PlannedUserMixin,TestCase):
+	"""Sampled requests report query and phase timings."""
+	def test_server_timing_header(self):
+		response = self.client.get(reverse('planner:home'))
+		metrics = dict(
+			metric.split(';')[0:2] for metric in response['Server-Timing'].split(', '))
+		for name in ('total','sql','schedule_cache','schedule_plan',
+				'schedule_overlay','render'):
+			self.assertIn(name,metrics)
+		self.assertIn('queries"',response['Server-Timing'])
+
+	@override_settings(TIMING_LOG=True)
+	def test_log_line(self):
+		with self.assertLogs('planner.timing') as logs:
+			self.client.get(reverse('planner:home'))
+		line = json.loads(logs.records[0].getMessage())
+		self.assertEqual(line['view'],'planner:home')
+		self.assertEqual(line['status'],200)
+		self.assertGreater(line['queries'],0)
+		self.assertIn('render',line['phases'])
+
+	@override_settings(TIMING_SAMPLE_RATE=0)
+	def test_not_sampled(self):
+		response = self.client.get(reverse('planner:home'))
+		self.assertFalse(response.has_header('Server-Timing'))
+
+
+class QueryBudgetTests(TestCase):
+	"""Views going over their query budget are reported."""
+	def setUp(self):
+		cache.clear()
+		self.user = User.objects.create_user('runner',password='pw')
+		Profile.objects.create(owner=self.user)
+		self.client.force_login(self.user)
+
+	@override_settings(QUERY_BUDGETS={'planner:history':1},QUERY_BUDGET_MODE='raise')
+	def test_over_budget_raises(self):
+		with self.assertRaisesMessage(instrumentation.QueryBudgetExceeded,
+				'planner:history made'):
+			self.client.get(reverse('planner:history'))
+
+	@override_settings(QUERY_BUDGET_MODE='raise')
+	def test_within_budget(self):
+		response = self.client.get(reverse('planner:history'))
+		self.assertEqual(response.status_code,200)
+
+	@override_settings(QUERY_BUDGETS={'planner:history':1},QUERY_BUDGET_MODE='log')
+	def test_over_budget_logged(self):
+		with self.assertLogs('planner.queries','WARNING'):
+			response = self.client.get(reverse('planner:history'))
+		self.assertEqual(response.status_code,200)
+
+	@override_settings(QUERY_BUDGETS={'planner:mileage':1},QUERY_BUDGET_MODE='count')
+	def test_count_mode(self):
+		before = instrumentation.query_budget_stats().get(
+			'planner:mileage',{'requests':0,'over_budget':0})
+		response = self.client.get(reverse('planner:mileage'))
+		self.assertEqual(response.status_code,200)
+		after = instrumentation.query_budget_stats()['planner:mileage']
+		self.assertEqual(after['requests'],before['requests'] + 1)
+		self.assertEqual(after['over_budget'],before['over_budget'] + 1)
+
+	def test_repeated_sql_report(self):
+		queries = instrumentation.QueryLog()
+		with connection.execute_wrapper(queries):
+			for _ in range(3):
+				Profile.objects.get(owner=self.user)
+		report = instrumentation.budget_report('planner:home',1,queries)
+		self.assertIn('made 3 queries, budget is 1',report)
+		self.assertIn('3 x SELECT',report)
+		self.assertIn('planner/tests.py',report)
+
+
+class NewUserQueryBudgetTests(TransactionTestCase):
+	"""
+	A new user's first home page, which creates their profile, is within
+	budget. Not run in a transaction, so queries are counted as in production.
+	"""
+	@override_settings(QUERY_BUDGET_MODE='raise')
+	def test_register_then_home(self):
+		response = self.client.post(reverse('users:register'),{
+			'username':'runner','password1':'a long pass phrase','password2':'a long pass phrase'},
+			follow=True)
+		self.assertEqual(response.status_code,200)
+		self.assertEqual(response.redirect_chain,[(reverse('planner:home'),302)])
+		self.assertTrue(Profile.objects.filter(owner__username='runner').exists())
+
+
+class MetricsTests(TestCase):
+	"""/metrics adds up request metrics written by every worker."""
+	def setUp(self):
+		cache.clear()
+		self.metrics_dir = tempfile.TemporaryDirectory()
+		self.addCleanup(self.metrics_dir.cleanup)
+		settings_override = override_settings(METRICS_DIR=self.metrics_dir.name)
+		settings_override.enable()
+		self.addCleanup(settings_override.disable)
+		self.user = User.objects.create_user('runner',password='pw',is_staff=True)
+		Profile.objects.create(owner=self.user)
+		self.client.force_login(self.user)
+
+	def scrape(self):
+		response = self.client.get(reverse('planner:metrics'))
+		self.assertEqual(response.status_code,200)
+		return {
+			line.rsplit(' ',1)[0]:float(line.rsplit(' ',1)[1])
+			for line in response.content.decode().splitlines()
+			if not line.startswith('#')
+			}
+
+	def test_request_histograms(self):
+		before = self.scrape().get(
+			'planner_request_duration_seconds_count{view="planner:history"}',0)
+		self.client.get(reverse('planner:history'))
+		values = self.scrape()
+		self.assertEqual(
+			values['planner_request_duration_seconds_count{view="planner:history"}'],
+			before + 1)
+		self.assertIn(
+			'planner_request_queries_bucket{view="planner:history",le="+Inf"}',values)
+
+	def test_workers_added_up(self):
+		before = self.scrape().get('planner_submits_total',0)
+		worker = {
+			'counters':[['planner_submits_total',{},5]],
+			'histograms':[['planner_request_queries',{'view':'planner:home'},
+				[1] * (len(metrics.QUERY_BUCKETS) + 1),40]],
+			}
+		with open(f'{self.metrics_dir.name}/worker-1-1.json','w') as file:
+			json.dump(worker,file)
+		values = self.scrape()
+		self.assertEqual(values['planner_submits_total'],before + 5)
+		self.assertGreaterEqual(
+			values['planner_request_queries_bucket{view="planner:home",le="+Inf"}'],
+			len(metrics.QUERY_BUCKETS) + 1)
+
+	def test_submit_counted(self):
+		act = CrossTrain(owner=self.user,exercise_type='Swim')
+		act.setvalues()
+		act.save()
+		before = self.scrape().get('planner_submits_total',0)
+		self.client.post(
+			reverse('planner:submitdate',args=[act.id,date.today().isoformat()]),
+			{'difficulty':'2'})
+		self.assertEqual(self.scrape()['planner_submits_total'],before + 1)
+
+	def test_stale_workers_removed(self):
+		path = Path(self.metrics_dir.name) / 'worker-1-1.json'
+		path.write_text(json.dumps({
+			'counters':[['planner_submits_total',{},1000]],'histograms':[]}))
+		old = time.time() - 600
+		os.utime(path,(old,old))
+		self.assertLess(self.scrape().get('planner_submits_total',0),1000)
+		self.assertFalse(path.exists())
+
+	def test_staff_only(self):
+		url = reverse('planner:metrics')
+		self.user.is_staff = False
+		self.user.save()
+		self.assertEqual(self.client.get(url).status_code,401)
+		with override_settings(DEBUG=True):
+			self.assertEqual(self.client.get(url).status_code,200)
+
+	@override_settings(METRICS_TOKEN='secret',DEBUG=True)
+	def test_token(self):
+		url = reverse('planner:metrics')
+		self.client.logout()
+		self.assertEqual(self.client.get(url).status_code,401)
+		response = self.client.get(url,HTTP_AUTHORIZATION='Bearer secret')
+		self.assertEqual(response.status_code,200)
+
+
+class ProfilingTests(TestCase):
+	"""Staff can profile requests and list the slowest."""
+	def setUp(self):
+		self.profile_dir = tempfile.TemporaryDirectory()
+		self.addCleanup(self.profile_dir.cleanup)
+		settings_override = override_settings(
+			PROFILE_DIR=self.profile_dir.name,PROFILE_KEEP=2)
+		settings_override.enable()
+		self.addCleanup(settings_override.disable)
+		self.user = User.objects.create_user('runner',password='pw',is_staff=True)
+		Profile.objects.create(owner=self.user)
+		self.client.force_login(self.user)
+
+	def profiled_requests(self):
+		return sorted(path.name for path in Path(self.profile_dir.name).glob('*.json'))
+
+	def test_header_profiles_request(self):
+		self.client.get(reverse('planner:history'))
+		self.assertEqual(self.profiled_requests(),[])
+		self.client.get(reverse('planner:history'),HTTP_X_PROFILE='1')
+		self.assertEqual(len(self.profiled_requests()),1)
+		response = self.client.get(reverse('planner:profiles'))
+		self.assertContains(response,'planner:history')
+		self.assertContains(response,'view_history')
+
+	def test_header_ignored_for_other_users(self):
+		self.user.is_staff = False
+		self.user.save()
+		self.client.get(reverse('planner:history'),HTTP_X_PROFILE='1')
+		self.assertEqual(self.profiled_requests(),[])
+		response = self.client.get(reverse('planner:profiles'))
+		self.assertEqual(response.status_code,302)
+
+	@override_settings(PROFILE_SAMPLE_RATE=1)
+	def test_rotation(self):
+		for _ in range(4):
+			self.client.get(reverse('planner:mileage'))
+		self.assertEqual(len(self.profiled_requests()),2)
+		self.assertEqual(len(list(Path(self.profile_dir.name).iterdir())),4)
+
+	def test_dump_download(self):
+		self.client.get(reverse('planner:history'),HTTP_X_PROFILE='1')
+		summary = json.loads(next(Path(self.profile_dir.name).glob('*.json')).read_text())
+		response = self.client.get(reverse('planner:profile_dump',args=[summary['dump']]))
+		self.assertEqual(response.status_code,200)
+		response = self.client.get(reverse('planner:profile_dump',args=['..']))
+		self.assertEqual(response.status_code,404)
+
+
+class AsyncViewTests(PlannedUserMixin,TransactionTestCase):
+	"""Async views show the same pages, loading data in worker threads."""
+	def setUp(self):
+		super().setUp()
+		ActivityLog.objects.create(owner=self.user,date=date.today(),name='Logged run')
+		WeeklyMileage.objects.create(owner=self.user,
+			week_start=get_initial_date(date.today()),distance=Decimal('12.5'))
+		self.async_client.force_login(self.user)
+
+	def get(self,view,user=None):
+		request = AsyncRequestFactory().get('/')
+		request.user = user or self.user
+		return view(request)
+
+	async def test_home(self):
+		response = await self.get(views.async_home)
+		self.assertContains(response,'Swim')
+
+	async def test_home_activities_not_loaded(self):
+		# Loaded while rendering, only if the cached table has expired.
+		with mock.patch.object(views,'render_home',return_value=HttpResponse()) as render_home:
+			await self.get(views.async_home)
+		request,profile,schedule_list,activities = render_home.call_args.args
+		self.assertEqual(len(schedule_list),14)
+		self.assertIsNone(activities._result_cache)
+
+	async def test_history(self):
+		response = await self.get(views.async_view_history)
+		self.assertContains(response,'Logged run')
+
+	async def test_mileage(self):
+		response = await self.get(views.async_mileage)
+		self.assertContains(response,'12.5')
+
+	async def test_login_required(self):
+		response = await self.get(views.async_mileage,AnonymousUser())
+		self.assertEqual(response.status_code,302)
+
+	@override_settings(ROOT_URLCONF='planner.management.commands.bench_async',
+		QUERY_BUDGETS={'bench_async:mileage':1},QUERY_BUDGET_MODE='raise')
+	async def test_worker_thread_queries_counted(self):
+		# Session, user and mileage queries, the last in a worker thread.
+		with self.assertRaisesMessage(instrumentation.QueryBudgetExceeded,
+				'bench_async:mileage made 3 queries'):
+			await self.async_client.get(reverse('bench_async:mileage'))
+
+	@override_settings(ROOT_URLCONF='planner.management.commands.bench_async',
+		QUERY_BUDGET_MODE='raise')
+	async def test_within_budget(self):
+		for name in ('home','history','mileage'):
+			response = await self.async_client.get(reverse(f'bench_async:{name}'))
+			self.assertEqual(response.status_code,200)
+
+	def test_bench_async(self):
+		out = StringIO()
+		call_command('bench_async','runner',requests=2,concurrency=2,stdout=out)
+		self.assertIn('home async',out.getvalue())
+		self.assertIn('mileage sync',out.getvalue())
+
+
+class HomeFragmentCacheTests(PlannedUserMixin,TestCase):
+	"""Schedule and activity tables are cached until they change."""
+	def test_cached_tables_not_queried(self):
+		first = self.client.get(reverse('planner:home'))
+		with CaptureQueriesContext(connection) as queries:
+			second = self.client.get(reverse('planner:home'))
+		self.assertEqual(first.content,second.content)
+		self.assertFalse(
+			[query for query in queries.captured_queries if 'planner_activity' in query['sql']])
+
+	def test_submit_links(self):
+		response = self.client.get(reverse('planner:home'))
+		self.assertContains(response,
+			reverse('planner:submitdate',args=[self.act.id,date.today().isoformat()]))
+
+	def test_edit_shown(self):
+		self.client.get(reverse('planner:home'))
+		self.client.post(reverse('planner:edit',args=[self.act.id]),
+			{'exercise_type':'Bike'})
+		response = self.client.get(reverse('planner:home'))
+		self.assertContains(response,'Bike')
+		self.assertNotContains(response,'Swim')
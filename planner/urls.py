@@ -1,11 +1,18 @@
+from django.conf import settings
 from django.urls import path
 
 from . import views
 
+# Async versions of the busiest views are used when served by an ASGI server.
+if settings.ASYNC_VIEWS:
+	home, history, mileage = views.async_home, views.async_view_history, views.async_mileage
+else:
+	home, history, mileage = views.home, views.view_history, views.mileage
+
 # url aths for Planner app
 app_name = 'planner'
 urlpatterns = [
-	path('',views.home,name='home'),
+	path('',home,name='home'),
 	path('addnew/',views.add_new,name='addnew'),
 	path('addnew/<str:act_type>/',views.add_new,name='addnew'),
 	path('setgoal/',views.setgoal,name='setgoal'),
@@ -18,17 +25,28 @@ urlpatterns = [
 	path('submit/<int:act_id>/<str:date_iso>/',views.submit,name='submitdate'),
 	# Submit details of rest day
 	path('submit/<str:date_iso>/',views.restdate,name='restdate'),
+	# Submit all missed days at once
+	path('catchup/',views.catchup,name='catchup'),
 	path('generate/',views.generate_plan,name='generate'),
 	# Save changes to general settings.
 	path('settings/',views.settings,name='settings'),
 	# Save changes to pace settings.
 	path('savepace/', views.savepacesettings,name='savepacesettings'),
-	path('history/',views.view_history,name='history'),
-	path('mileage/', views.mileage,name='mileage'),
+	path('history/',history,name='history'),
+	path('mileage/',mileage,name='mileage'),
+	# Download history, mileage or completed activities as csv / ndjson
+	path('export/<str:dataset>/<str:fmt>/',views.export,name='export'),
+	# Upload activities from other tools
+	path('import/',views.import_activities,name='import'),
 	# Delete various data from profile
 	path('reset/<str:route>',views.reset,name='reset'),
 	path('reset/<str:route>/<str:delete>',views.reset,name='reset'),
 	path('userguide/',views.helpscreen,name='helpscreen'),
+	# Request metrics for Prometheus
+	path('metrics',views.view_metrics,name='metrics'),
+	# Slowest profiled requests, staff only
+	path('profiles/',views.view_profiles,name='profiles'),
+	path('profiles/<str:name>',views.profile_dump,name='profile_dump'),
 	]
 
 	
\ No newline at end of file
@@ -1,15 +1,28 @@
 from django.shortcuts import render, redirect
+from django.urls import reverse
+from django.conf import settings as django_settings
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
-from django.http import Http404
-from datetime import date, timedelta, datetime
-import json
+from django.contrib.auth.views import redirect_to_login
+from django.http import Http404, HttpResponse, StreamingHttpResponse, FileResponse
+from django.db import transaction, IntegrityError, close_old_connections
+from django.db.models import Q, F
+from django.utils.crypto import constant_time_compare
+from asgiref.sync import sync_to_async
+from datetime import date, timedelta
 from decimal import Decimal
+import csv
+import itertools
+import json
 
 from .models import (Activity, PacedRun, Intervals, TimeTrial, CrossTrain, 
-	Profile, CompletedAct)
+	Profile, CompletedAct, ActivityLog, WeeklyMileage, PlanSlot, WEEKS_CHOICES,
+	DIFF_CHOICES, estimate_distance)
+from . import caching, importers, metrics, profiling
+from .instrumentation import phase, query_budget
 from .forms import (PR_Form, Int_Form, TT_Form, CT_Form, 
 	PR_Goal_Form, Int_Goal_Form, SubmissionForm, TT_SubForm, 
-	Profile_Form, PaceForm, PlanForm )
+	Profile_Form, PaceForm, PlanForm, ImportForm )
 
 
 # List of all activity models.
@@ -49,6 +62,38 @@ SUB_FORMS = {
 # Global values for frequently used strings.
 dateFormat = "%a %d %b"
 rest_string = "Rest Day"
+DAY_NAMES = ('Mon','Tue','Wed','Thu','Fri','Sat','Sun')
+MONTH_NAMES = ('','Jan','Feb','Mar','Apr','May','Jun','Jul','Aug','Sep','Oct',
+	'Nov','Dec')
+# Maps (plan length, schedule week) to the numbers of the 14 plan days shown 
+# on the two week schedule; the current plan week followed by the next one.
+PLAN_DAYS = {
+	(length,week):tuple(
+		(plan_week * 7) + day + 1
+		for plan_week in (week,(week + 1) % length)
+		for day in range(7)
+		)
+	for length,_ in WEEKS_CHOICES
+	for week in range(length)
+	}
+# Number of days completed acts are kept for before being purged.
+COMPLETED_RETENTION_DAYS = 29
+# Number of entries shown on each page of activity history.
+HISTORY_PAGE_SIZE = 50
+# Number of weeks shown on weekly distance page.
+MILEAGE_WEEKS = 52
+# Data which can be exported: model and the fields exported, in column order.
+EXPORTS = {
+	'history':(ActivityLog,('date','name','distance')),
+	'mileage':(WeeklyMileage,('week_start','distance')),
+	'completed':(CompletedAct,('date_done','name','distance')),
+	}
+EXPORT_FORMATS = {
+	'csv':'text/csv',
+	'ndjson':'application/x-ndjson',
+	}
+# Number of rows fetched from the database, and sent, at a time when exporting.
+EXPORT_CHUNK_SIZE = 500
 
 ### VIEW FUNCTIONS ###
 def helpscreen(request):
@@ -56,84 +101,120 @@ def helpscreen(request):
 	return render(request,'planner/helpscreen.html')
 
 
+@query_budget(4)
 @login_required
 def view_history(request):
 	"""
-	Return page showing table of weekly distance totals.
+	Return page showing table of completed activities, newest first. Later
+	pages are selected with the date and id of the last entry already shown, 
+	so each page costs the same whatever the length of the history.
 	"""
-	context = {}
-	profile = get_profile(request.user)
-	if profile.history:
-		try:
-			history_list = json.loads(profile.history)
-			context['history_list'] = history_list
-		except:
-			context['message'] = 'Error loading history.'
-	
-	else:
-		context['message'] = 'No history to show yet! Please try harder.'
-					
+	context = get_history_context(request.user,request.GET.get('before'))
 	return render(request,'planner/history.html',context)	 
 
 	
+@query_budget(4)
 @login_required
 def mileage(request):
 	"""
 	Render history of weekly distance.
 	"""
-	context={}
-	profile=get_profile(request.user)
-	if profile.mileage_history:
-		history_list = json.loads(profile.mileage_history)
-		context['history_list']=history_list
-	else:
-		context['message']='No mileage history yet, complete some activities.'	
-	
+	context = get_mileage_context(request.user)
 	return render(request, 'planner/mileage_history.html',context)
 
 
+@login_required
+def export(request,dataset,fmt):
+	"""
+	Download all of user's history, weekly distance or completed activities as
+	CSV or NDJSON. Rows are streamed as they are read from the database, so
+	memory use does not grow with the amount of data.
+	"""
+	if dataset not in EXPORTS or fmt not in EXPORT_FORMATS:
+		raise Http404
+	model,fields = EXPORTS[dataset]
+	rows = (model.objects.filter(owner=request.user)
+		.values_list(*fields)
+		.iterator(chunk_size=EXPORT_CHUNK_SIZE))
+	response = StreamingHttpResponse(
+		export_lines(rows,fields,fmt),
+		content_type=EXPORT_FORMATS[fmt],
+		)
+	response['Content-Disposition'] = (
+		f'attachment; filename="kanplan-{dataset}.{fmt}"')
+	return response
+
+
+@login_required
+def import_activities(request):
+	"""
+	Page for uploading CSV or GPX files of activities logged elsewhere, which
+	are added to user's history and weekly distance. Nothing is saved if any
+	of the files cannot be read.
+	"""
+	context = {}
+	form = ImportForm()
+	if request.method == 'POST':
+		form = ImportForm(request.POST,request.FILES)
+		if form.is_valid():
+			entries = itertools.chain.from_iterable(
+				importers.parse_upload(uploaded)
+				for uploaded in request.FILES.getlist('files')
+				)
+			try:
+				count,_ = importers.save_entries(request.user,entries)
+			except importers.ImportFileError as error:
+				context['message'] = f'Nothing imported. {error}'
+			else:
+				context['message'] = f'Imported {count} activities.'
+	context['form'] = form
+	return render(request,'planner/import.html',context)
+
+
+def view_metrics(request):
+	"""
+	Request and cache metrics of all worker processes in the Prometheus text
+	format. Requests must send settings.METRICS_TOKEN as a bearer token or be
+	by a staff user, unless in debug mode without a token set.
+	"""
+	token = getattr(django_settings,'METRICS_TOKEN',None)
+	sent_token = token and constant_time_compare(
+		request.headers.get('Authorization',''),f'Bearer {token}')
+	# Checked last, so scrapes sending the token do not load the user.
+	if not (sent_token or (django_settings.DEBUG and not token) or request.user.is_staff):
+		return HttpResponse(status=401)
+	return HttpResponse(metrics.exposition(),
+		content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@staff_member_required
+def view_profiles(request):
+	"""Staff only page listing the slowest profiled requests."""
+	context = {'profiles':profiling.slowest()}
+	return render(request,'planner/profiles.html',context)
+
+
+@staff_member_required
+def profile_dump(request,name):
+	"""Download the profile dump of a profiled request."""
+	path = profiling.profile_dir() / name
+	if path.name != name or path.suffix not in ('.prof','.html') or not path.is_file():
+		raise Http404
+	return FileResponse(path.open('rb'),as_attachment=True)
+
+
+@query_budget(8)
 def home(request):
 	"""
 	Displays schedule, activities, links for edit/ creation screen.
 	"""
-	# Declare context dictionary
-	context = {}
 	# Generate home screen if user logged in, if not prompt to login /register
-	if request.user.is_authenticated:
-		# Get User profile
-		profile = get_profile(request.user)
-		# If user has a saved plan, generate schedule.
-		if profile.plan:
-			schedule_list = get_schedule_list(profile)
-			# Check if schedule list has uncompleted activities, if it does 
-			# redirect to update view.
-			update_list = update_schedule(schedule_list)
-			if update_list:
-				return render(
-					request,
-					'planner/update.html',
-					context={'update_list':update_list},
-					)		
-			# Add 'past' attribute to any completed non-rest days.
-			for day in schedule_list:
-				if day.name != rest_string and day.complete == True:
-					day.past = True
-			# Add updated schedule to context dict.
-			context['schedule_list'] = schedule_list
-		
-		else:
-			# No plan, prompt message to create one
-			message = 'Use links below to create activities/ plan'
-			context['no_plan_message'] = message
-		
-		# Get list of user's activities for home screen.
-		activities = Activity.objects.filter(owner=request.user)
-		context['activities'] = activities
-		# Add string representing today's date to context dictionary,
-		# used when submitting activity from activity table.
-		context['date_iso'] = date.today().isoformat()
-	
-	return render(request,'planner/home.html', context)
+	if not request.user.is_authenticated:
+		return render(request,'planner/home.html',{})
+	schedule_list = get_home_schedule(request.profile)
+	# Get list of user's activities for home screen.
+	activities = Activity.objects.filter(owner=request.user).select_subclasses()
+	return render_home(request,request.profile,schedule_list,activities)
 
 
 @login_required
@@ -147,8 +228,9 @@ def add_new(request,act_type=''):
 		if form.is_valid():
 			new_activity = form.save(commit=False)
 			new_activity.owner = request.user
-			new_activity.setvalues(get_profile(request.user))
+			new_activity.setvalues(request.profile)
 			new_activity.save()
+			caching.invalidate_activities(request.user.id)
 			# If new activity is progressive, render view for setting goals.
 			if new_activity.progressive:
 				goal_form = GOAL_FORMS[act_type]
@@ -179,7 +261,7 @@ def settings(request):
 	Renders edit user preferences page.
 
 	"""
-	profile = get_profile(request.user)
+	profile = request.profile
 	
 	if request.method != 'POST':
 		form = Profile_Form(instance=profile)
@@ -190,16 +272,17 @@ def settings(request):
 	else:
 		# POST request, submitted form
 		# Save new values	
+		old_length = profile.plan_length
 		form = Profile_Form(instance=profile,data=request.POST)
 		if form.is_valid():
 			form.save()
 		# Check if user has changed plan length setting, if it has been 
 		# changed clear plan.
-		if form['plan_length'] != profile.plan_length:
-			
-			profile.schedule_week = 0
-			profile.plan = None
-			profile.save()
+		if profile.plan_length != old_length:
+			PlanSlot.objects.filter(profile=profile).delete()
+			profile.plan_start_date = None
+			profile.save(update_fields=['plan_start_date'])
+			caching.invalidate_schedule(request.user.id)
 		return redirect('planner:home')
 
 
@@ -209,23 +292,24 @@ def savepacesettings(request):
 	Saves submitted pace settings form.
 	"""
 	if request.method == 'POST':
-		profile = get_profile(request.user)		
+		profile = request.profile		
 		pace_form = PaceForm(instance=profile,data=request.POST)
 		if pace_form.is_valid():
-			pace_form.save()
+			with transaction.atomic():
+				pace_form.save()
+				# Update distances estimated from the old paces.
+				recompute_distances(profile)
 	return redirect('planner:home')
 
 
+@query_budget(14)
 @login_required
 def submit(request,act_id,date_iso):
 	"""Serve page where user can submit details of completed activity"""
 	# Serving form to edit activity.
 	if request.method != 'POST':
-		# Get activity
-		activity = get_act(act_id)
-		if not activity or (activity.owner != request.user):
-			# Get request has invalid id or id does no bleong to user.
-			raise Http404 	
+		# Get activity, 404 if invalid id or id does not belong to user.
+		activity = get_user_act(request.user,act_id)
 		# Prepopulate form for editing.
 		form = SUB_FORMS[activity.my_type]
 		context = {
@@ -237,49 +321,30 @@ def submit(request,act_id,date_iso):
 
 	# Handling submitted form.
 	elif request.method == 'POST':
-		activity = get_act(request.POST.get('act_id'))
-		# Check ownership (shouldn't actually be needed)
-		if activity.owner != request.user:
-			raise Http404
-		model = get_model(activity.my_type)
-		# Get instance.
-		this_act = model.objects.get(id=act_id)
-		# create CompletedAct instance.  
-		distance = this_act.distance or 0
+		# Get instance of the activity's concrete type.
+		this_act = get_user_act(request.user,act_id)
 		date_done = date.fromisoformat(date_iso)
-		completedact = CompletedAct(
-			owner=request.user,
-			date_done=date_done,
-			name = this_act.name,
-			distance=distance,
-			)
-		completedact.save()
-		# Update Activity values from Post data
-		this_act.update(request.POST,date_done)
-		if this_act.progressive and request.POST.get('completed'):
-				this_act.progress()
-		profile = get_profile(request.user)
-		this_act.setvalues(profile)
-		this_act.save()
-		# Update user's history
-		profile = update_history(profile,date_iso,distance,activity.name)
-		# If activity has distance value, use it to update mileage.
-		if distance:
-			profile = update_mileage(profile,date_done,distance)
-		# Delete any completed acts that are no longer needed
-		clean_completed_acts(request.user,29)
-		profile.save()		
+		with phase('submit_save'):
+			save_completion(
+				request.user,
+				date_done,
+				this_act,
+				request.POST,
+				request.profile,
+				)
+		metrics.inc('planner_submits_total')
 
 	return redirect('planner:home')	
 		
 
+@query_budget(12)
 @login_required
 def generate_plan(request):
 	"""
 	Returns page for setting new plan, saves submitted plan to profile.
 	"""
 	context ={}
-	profile = get_profile(request.user)
+	profile = request.profile
 	weeks = profile.plan_length
 	choices = get_plan_choices(request.user)
 	if len(choices) == 1:
@@ -288,57 +353,51 @@ def generate_plan(request):
 		context['message'] = message
 	# initial dictionary is used to pre-populate the plan form with user's 
 	# current plan, if they have one.
-	try:
-		initial_dict = json.loads(profile.plan)
-	except:
-		initial_dict = {}
+	initial_dict = {
+		f'day_{slot.day_index}':slot.activity_id or 'REST'
+		for slot in PlanSlot.objects.filter(profile=profile)
+		}
 	# Generate custom form with correct number of fields, choices.	
 	form = PlanForm(weeks,choices,initial_dict)
 	if request.method == 'POST':
 		#check and save form
 		form = PlanForm(weeks,choices,request.POST)
-		plan_dict = request.POST.dict()
-		# Remove unnecessary fields.
-		plan_dict.pop('csrfmiddlewaretoken')
-		plan_dict.pop('submit')	
-		# Save submitted plan form values to JSON field on profile.
-		profile.plan = json.dumps(plan_dict)
-		profile.save()
+		# Save submitted plan form values as the profile's plan slots.
+		save_plan(profile,request.POST,choices)
+		set_plan_start(profile)
+		caching.invalidate_schedule(request.user.id)
 		return redirect('planner:home')		
 	context['form'] = form
-	day_list = get_lists(weeks)
-	context.update(day_list)
+	context['day_names'] = DAY_NAMES
+	context['plan_weeks'] = get_plan_weeks(form,weeks)
 	return render(request,'planner/plan.html',context)
 
 
+@query_budget(10)
 @login_required
 def edit(request,act_id=None):
 	"""edit the details of an activity"""
 	# Get activity instance.
 	if not act_id:
 		act_id = request.POST.get('act_id')
-	activity = get_act(act_id)
-	if not activity:
-		raise Http404
-	# Check ownership.
-	if activity.owner != request.user:
-		raise Http404			
-	this_act = get_model(activity.my_type).objects.get(id=act_id)
+	this_act = get_user_act(request.user,act_id)
 	# Save submitted Form.		
 	if request.method == 'POST':
 		form = ADD_FORMS[this_act.act_type](instance=this_act,data=request.POST)
 		if form.is_valid():
 			form.save()
-		this_act.setvalues(get_profile(request.user))
+		this_act.setvalues(request.profile)
 		this_act.save()
+		caching.invalidate_schedule(request.user.id)
+		caching.invalidate_activities(request.user.id)
 		# If progressive, go to setgoals page.
 		if this_act.progressive:
-			goal_form = GOAL_FORMS[activity.my_type]
+			goal_form = GOAL_FORMS[this_act.my_type]
 			goal_form = goal_form(this_act.goal_prepop())
 			context = {
 					'goal_form':goal_form,
 					'act_id':act_id,
-					'act_type':activity.my_type
+					'act_type':this_act.my_type
 					}
 			return render(request,'planner/setgoal.html',context)		
 		# Non-progressive, redirect home.	
@@ -347,7 +406,7 @@ def edit(request,act_id=None):
 	form = ADD_FORMS[this_act.act_type](instance=this_act)
 	context = {
 		'form':form,
-		'name':activity.name,
+		'name':this_act.name,
 		'act_id':act_id
 	}
 	return render(request,'planner/edit.html',context)
@@ -358,17 +417,19 @@ def reset(request,route,delete=None):
 	"""For resetting various profile data."""
 	# Delete confirmation, reset field.
 	if delete == 'delete':
-		profile = get_profile(request.user)
+		profile = request.profile
 		if route == 'plan':
-			profile.plan = None	
+			PlanSlot.objects.filter(profile=profile).delete()
+			profile.plan_start_date = None
+			profile.save(update_fields=['plan_start_date'])
 		if route == 'activity_hist':
-			profile.history = None
+			ActivityLog.objects.filter(owner=request.user).delete()
 
 		if route == 'distance_hist':
-			profile.mileage_history = None
+			WeeklyMileage.objects.filter(owner=request.user).delete()
 		# Delete all completed acts.
 		clean_completed_acts(request.user,-1)
-		profile.save()
+		caching.invalidate_schedule(request.user.id)
 		return redirect('planner:home')	
 
 	context = {'reset_visible':True}
@@ -381,19 +442,16 @@ def delete(request, act_id=None):
 	"""For deleting activities"""
 	if not act_id:
 		act_id = request.POST.get('act_id')
-	activity = get_act(act_id)
 	# Check that activity exists and belongs to user.
-	if not activity:
-		raise Http404
-	if activity.owner != request.user:
-		raise Http404	
+	activity = get_user_act(request.user,act_id)
 	if request.method != 'POST':
 		# From link - serve confirmation form
 		context = {'activity':activity}
 		return render(request,'planner/delete.html',context)
 	if request.method == 'POST':	
 		activity.delete()
-		# Delete any completed acts that		
+		caching.invalidate_schedule(request.user.id)
+		caching.invalidate_activities(request.user.id)
 		return redirect('planner:home')
 
 
@@ -404,32 +462,281 @@ def restdate(request,date_iso):
 	"""
 	# Create and save a completed act object with no associated act / distance.
 	date_done = date.fromisoformat(date_iso)	
-	history = CompletedAct(
-		owner=request.user,
-		date_done=date_done,
-		name=rest_string,
-		distance=0.0
-		)
-	history.save()
+	save_completion(request.user,date_done)
 	return redirect('planner:home')	
 
 
+@query_budget(16)
+@login_required
+def catchup(request):
+	"""
+	Saves all days submitted from the missed days update page in one request.
+	Each day is either marked done, with its difficulty and whether targets
+	were met, or missed, which saves it as a rest day.
+	"""
+	if request.method != 'POST':
+		return redirect('planner:home')
+	days = []
+	for date_iso in request.POST.getlist('date_iso'):
+		try:
+			date_done = date.fromisoformat(date_iso)
+		except ValueError:
+			raise Http404
+		status = request.POST.get(f'status_{date_iso}')
+		if status == 'done':
+			days.append((date_done,request.POST.get(f'act_{date_iso}'),date_iso))
+		elif status == 'missed':
+			days.append((date_done,None,None))
+	# Fetch all of the activities in one query.
+	activities = get_act_map(
+		request.user,
+		[act_id for _,act_id,_ in days if act_id],
+		select_subclasses=True,
+		)
+	completions = []
+	for date_done,act_id,date_iso in days:
+		if act_id is None:
+			completions.append((date_done,None,None))
+			continue
+		activity = activities.get(act_id)
+		if not activity:
+			raise Http404
+		# Fields for each day are named <field>_<date_iso>.
+		suffix = f'_{date_iso}'
+		post = {
+			key[:-len(suffix)]:value for key,value in request.POST.items()
+			if key.endswith(suffix)
+			}
+		# Days sent without a difficulty keep the activity's current one.
+		post.setdefault('difficulty',activity.difficulty)
+		completions.append((date_done,activity,post))
+	with phase('submit_save'):
+		save_completions(request.user,completions,request.profile)
+	metrics.inc('planner_submits_total',
+		sum(1 for _,activity,_ in completions if activity))
+	return redirect('planner:home')
+
+
 @login_required
 def setgoal(request):
 	"""Saves values returned from set goal forms when editing or creating"""
-	# get activity type
-	model = get_model(request.POST.get('act_type'))
 	# Get activity being altered.
-	act_id = request.POST.get('act_id')
-	activity = model.objects.get(id=act_id)
+	activity = get_user_act(request.user,request.POST.get('act_id'))
 	# Give the values to activity and have it update itself
 	activity.setgoals(request.POST)
-	activity.setvalues(get_profile(request.user))
+	activity.setvalues(request.profile)
 	activity.save()	
+	caching.invalidate_schedule(request.user.id)
+	caching.invalidate_activities(request.user.id)
 	return redirect('planner:home')
 
 
+### ASYNC VIEW FUNCTIONS ###
+# Async versions of home, view_history and mileage, served in their place by
+# ASGI servers (see settings.ASYNC_VIEWS). Django 4.0 has no async ORM, so
+# queries run in worker threads, see concurrent().
+
+@query_budget(4)
+async def async_view_history(request):
+	"""Async view_history."""
+	user = await get_async_user(request)
+	if user is None:
+		return redirect_to_login(request.get_full_path())
+	context = await concurrent(get_history_context)(user,request.GET.get('before'))
+	return await sync_to_async(render)(request,'planner/history.html',context)
+
+
+@query_budget(4)
+async def async_mileage(request):
+	"""Async mileage."""
+	user = await get_async_user(request)
+	if user is None:
+		return redirect_to_login(request.get_full_path())
+	context = await concurrent(get_mileage_context)(user)
+	return await sync_to_async(render)(request,'planner/mileage_history.html',context)
+
+
+@query_budget(8)
+async def async_home(request):
+	"""
+	Async home. The activity list is left lazy, so it is only loaded while
+	rendering if its cached fragment has expired.
+	"""
+	user = await get_async_user(request)
+	if user is None:
+		return await sync_to_async(render)(request,'planner/home.html',{})
+	profile = await sync_to_async(get_profile)(user)
+	schedule_list = await concurrent(get_home_schedule)(profile)
+	activities = Activity.objects.filter(owner=user).select_subclasses()
+	return await sync_to_async(render_home)(request,profile,schedule_list,activities)
+
+
 ### HELPERS ###
+def concurrent(func):
+	"""
+	Wraps sync function func for async views. Each call runs in a worker
+	thread of its own, with its own database connection, so the event loop
+	is not blocked while it waits for the database. The async views await
+	one call at a time, so their queries do not run in parallel. The
+	connection is closed afterwards unless it is persistent (settings
+	CONN_MAX_AGE).
+	"""
+	def run(*args,**kwargs):
+		try:
+			return func(*args,**kwargs)
+		finally:
+			close_old_connections()
+	return sync_to_async(run,thread_sensitive=False)
+
+
+async def get_async_user(request):
+	"""Return request's logged in user, or None, for async views."""
+	return await sync_to_async(
+		lambda: request.user if request.user.is_authenticated else None)()
+
+
+def get_home_schedule(profile):
+	"""Return schedule list shown on home page, empty if there is no plan."""
+	# Profiles with a plan always have a plan start date.
+	if not profile.plan_start_date:
+		return []
+	return get_cached_schedule_list(profile)
+
+
+def render_home(request,profile,schedule_list,activities):
+	"""Render home page, or update page if any past days are not completed."""
+	context = {}
+	if schedule_list:
+		# Check if schedule list has uncompleted activities, if it does 
+		# redirect to update view.
+		update_list = update_schedule(schedule_list)
+		if update_list:
+			return render(
+				request,
+				'planner/update.html',
+				context={
+					'update_list':update_list,
+					'diff_choices':DIFF_CHOICES,
+					},
+				)		
+		# Add 'past' attribute to any completed non-rest days.
+		for day in schedule_list:
+			if day.name != rest_string and day.complete == True:
+				day.past = True
+		# Add updated schedule to context dict.
+		context['schedule_list'] = schedule_list
+	else:
+		# No plan, prompt message to create one
+		message = 'Use links below to create activities/ plan'
+		context['no_plan_message'] = message
+	# Left unevaluated, the query is only run if the table is not cached.
+	context['activities'] = activities
+	# Add string representing today's date to context dictionary,
+	# used when submitting activity from activity table.
+	context['date_iso'] = date.today().isoformat()
+	# Keys of the cached schedule and activity table fragments.
+	context['fragment_timeout'] = caching.FRAGMENT_TIMEOUT
+	if schedule_list:
+		context['schedule_key'] = caching.schedule_key(profile)
+	context['activities_version'] = caching.get_version(request.user.id,'activities')
+	context['submit_prefix'] = get_submit_prefix()
+	return render(request,'planner/home.html', context)
+
+
+def get_submit_prefix():
+	"""
+	Return start of the url for submitting an activity, to be followed by
+	'<act_id>/<date_iso>/', so it is reversed once instead of for every link.
+	"""
+	return reverse('planner:submitdate',args=[0,'x']).removesuffix('0/x/')
+
+
+def get_history_context(user,before=None):
+	"""
+	Return context for page of user's history, entries before before (date
+	and id of last entry on the previous page), or the first page.
+	"""
+	context = {}
+	history = ActivityLog.objects.filter(owner=user)
+	if before:
+		try:
+			before_date, before_id = before.split('_')
+			before_date = date.fromisoformat(before_date)
+			before_id = int(before_id)
+		except ValueError:
+			raise Http404
+		history = history.filter(
+			Q(date__lt=before_date) | Q(date=before_date,id__lt=before_id))
+	# Fetch one extra entry to find out whether there is another page.
+	history_list = list(history[:HISTORY_PAGE_SIZE + 1])
+	if len(history_list) > HISTORY_PAGE_SIZE:
+		history_list = history_list[:HISTORY_PAGE_SIZE]
+		last = history_list[-1]
+		context['next_page'] = f'{last.date.isoformat()}_{last.id}'
+	if history_list:
+		context['history_list'] = history_list
+	else:
+		context['message'] = 'No history to show yet! Please try harder.'
+	return context
+
+
+def get_mileage_context(user):
+	"""Return context for page of user's recent weekly distance."""
+	context = {}
+	first_week = get_initial_date(date.today()) - timedelta(weeks=MILEAGE_WEEKS)
+	history_list = list(WeeklyMileage.objects.filter(
+		owner=user,
+		week_start__gte=first_week,
+		))
+	if history_list:
+		context['history_list'] = history_list
+	else:
+		context['message'] = 'No mileage history yet, complete some activities.'
+	return context
+
+
+class Echo:
+	"""File-like object which returns what is written, for streaming csv."""
+	def write(self,value):
+		return value
+
+
+def export_lines(rows,fields,fmt):
+	"""
+	Generator of export file contents for rows of field values, in chunks of
+	EXPORT_CHUNK_SIZE lines. CSV starts with a header line.
+	"""
+	if fmt == 'csv':
+		writer = csv.writer(Echo())
+		# Header goes out before the query has run.
+		yield writer.writerow(fields)
+		lines = (writer.writerow(row) for row in rows)
+	else:
+		lines = (
+			json.dumps({
+				field:export_value(value) for field,value in zip(fields,row)
+				}) + '\n'
+			for row in rows
+			)
+	chunk = []
+	for line in lines:
+		chunk.append(line)
+		if len(chunk) == EXPORT_CHUNK_SIZE:
+			yield ''.join(chunk)
+			chunk = []
+	if chunk:
+		yield ''.join(chunk)
+
+
+def export_value(value):
+	"""Convert dates and decimals to JSON types for NDJSON export."""
+	if isinstance(value,date):
+		return value.isoformat()
+	if isinstance(value,Decimal):
+		return float(value)
+	return value
+
+
 def update_schedule(schedule_list):
 	"""
 	returns days that need updating, or 0 if there are none
@@ -473,120 +780,291 @@ def get_plan_choices(user):
 	return choices	
 
 
-def get_lists(weeks):
+def get_plan_weeks(form,weeks):
+	"""
+	Returns list of (week number, list of plan form fields for that week), 
+	used to lay out plan form one row per week.
+	"""
+	return [
+		(week + 1,[form[f'day_{(week * 7) + day + 1}'] for day in range(7)])
+		for week in range(weeks)
+		]
+
+
+def save_plan(profile,plan_dict,choices):
 	"""
-	Returns dict containing n=weeks lists of weekdays values, 'week_n' keys 
+	Replaces profile's plan with submitted plan form values, one PlanSlot for
+	each day of the plan. Values which are not one of the activity choices
+	are saved as rest days.
 	"""
-	days = ['Mon','Tue','Wed','Thu','Fri','Sat','Sun',]
-	day_dict = {}
-	for i in range(weeks):
-		day_dict[f'Week_{i+1}'] = days 
-	return day_dict	
+	act_ids = {str(act_id) for act_id,_ in choices if act_id != 'REST'}
+	slots = []
+	for day_index in range(1,(profile.plan_length * 7) + 1):
+		act_id = plan_dict.get(f'day_{day_index}')
+		slots.append(PlanSlot(
+			profile=profile,
+			day_index=day_index,
+			activity_id=int(act_id) if act_id in act_ids else None,
+			))
+	with transaction.atomic():
+		PlanSlot.objects.filter(profile=profile).delete()
+		PlanSlot.objects.bulk_create(slots)
+	return slots
 
 
 def clean_completed_acts(user_id,days):
 	"""
 	delete any of user's completed_acts older than specified days. Takes
-	user_id and number of days to be used as deletion criteria.
+	user_id and number of days to be used as deletion criteria. Returns number
+	of completed_acts deleted.
 	"""
-	try:
-		user_comp_acts = CompletedAct.objects.filter(owner=user_id)
-		for act in user_comp_acts:
-			if (date.today() - act.date_done).days >= days:
-				act.delete()
-		return 1	
-	except:
-		return 0 	
+	cutoff = date.today() - timedelta(days=days)
+	deleted, _ = CompletedAct.objects.filter(
+		owner=user_id,
+		date_done__lte=cutoff,
+		).delete()
+	return deleted
 
 
-def update_mileage(profile,date_done,act_distance=0):
+def save_completion(user,date_done,activity=None,post=None,profile=None):
 	"""
-	Add distance value to user's mileage total and return updated profile.
-	date_done should be date object, act_distance should be decimal.
-	
+	Records an activity completed on date_done, or a rest day if activity is
+	None, as a single transaction. Saves a CompletedAct, updates the activity
+	from submitted post data (writing only changed columns), and adds to
+	user's history and weekly mileage.
 	"""
-	# If activity has no distance value, return unmodified profile to avoid 
-	# creating empty rows
-	if not act_distance:
-		return profile
-	# string representing week beginning		
-	week_initial_str = get_initial_date(date_done).isoformat()	
-	# Load mileage history 
-	if profile.mileage_history:
-		history = json.loads(profile.mileage_history)
-	# Else if no user mileage history yet, create initial entry.
-	else:
-		history = [
-		{
-			'date':week_initial_str,
-			'distance':'0.0'
-			}
-		]		
-	# If current week still corresponds to history[0], add distance to that 
-	# week's total.
-	if history[0]['date'] == week_initial_str:
-		wtd_distance = Decimal(history[0]['distance'])
-		wtd_distance += Decimal(act_distance)
-		history[0]['distance'] = f'{wtd_distance}'
-	# If current week initial date not in history, create new entry
-	else:
-		# If (somehow) saving an activity that is in the past and a new
-		# week entry has already been made, return unmodified profile.
-		# if date older than history[0], ignore
-		if (date_done - date.fromisoformat(history[0]['date'])).days < 0: 
-			return profile
-		# Else if valid, create new entry and add to front of history.
+	with transaction.atomic():
+		if activity is None:
+			CompletedAct.objects.create(
+				owner=user,
+				date_done=date_done,
+				name=rest_string,
+				distance=0.0,
+				)
+		else:
+			# Record activity as it was done, before any progression.
+			name = activity.name
+			distance = activity.distance or 0
+			CompletedAct.objects.create(
+				owner=user,
+				date_done=date_done,
+				name=name,
+				distance=distance,
+				)
+			# Update Activity values from Post data
+			old_values = get_field_values(activity)
+			complete_activity(activity,post,date_done,profile)
+			save_changed(activity,old_values)
+			update_history(user,date_done,distance,name)
+			# If activity has distance value, use it to update mileage.
+			if distance:
+				update_mileage(user,date_done,distance)
+	caching.invalidate_schedule(user.id)
+	# Progression changes the activity's details.
+	caching.invalidate_activities(user.id)
 
-		entry = {
-			'date':week_initial_str,
-			'distance':str(act_distance)
-		}
-		history.insert(0,entry)
-
-	# Check history length and trim oldest if necessary
-	if len(history) > 50:
-		history = history[:49]	
-	#Update mileage field on history.
-	profile.mileage_history = json.dumps(history)
-	return profile		
-
-
-def update_history(profile,date_iso,distance,name):
-	# Create history entry
-	if not distance:
-		distance = 'n/a'
-	historyentry = {
-		'date':date_iso,
-		'name':name,
-		'distance':f'{distance}',
+
+def save_completions(user,completions,profile=None):
+	"""
+	Records several days at once, as a single transaction with a fixed number
+	of queries. completions is a list of (date_done, activity, post) tuples,
+	with activity None for a rest day. Days are applied in date order, so an
+	activity done on more than one day progresses each time.
+	"""
+	completed_acts = []
+	history = []
+	weeks = {}
+	old_values = {}
+	for date_done,activity,post in sorted(completions,key=lambda c: c[0]):
+		if activity is None:
+			completed_acts.append(CompletedAct(
+				owner=user,
+				date_done=date_done,
+				name=rest_string,
+				distance=0.0,
+				))
+			continue
+		# Record activity as it was done, before any progression.
+		name = activity.name
+		distance = activity.distance or 0
+		completed_acts.append(CompletedAct(
+			owner=user,
+			date_done=date_done,
+			name=name,
+			distance=distance,
+			))
+		history.append(ActivityLog(
+			owner=user,
+			date=date_done,
+			name=name,
+			distance=distance or None,
+			))
+		if distance:
+			week_start = get_initial_date(date_done)
+			weeks[week_start] = weeks.get(week_start,0) + distance
+		if activity.id not in old_values:
+			old_values[activity.id] = (activity,get_field_values(activity))
+		complete_activity(activity,post,date_done,profile)
+	with transaction.atomic():
+		CompletedAct.objects.bulk_create(completed_acts)
+		ActivityLog.objects.bulk_create(history)
+		bulk_save_changed(old_values.values())
+		for week_start,distance in weeks.items():
+			update_mileage(user,week_start,distance)
+	caching.invalidate_schedule(user.id)
+	caching.invalidate_activities(user.id)
+
+
+def complete_activity(activity,post,date_done,profile):
+	"""
+	Update activity's values from submitted completion form data, progressing
+	it if it is progressive and its targets were met.
+	"""
+	activity.update(post,date_done)
+	if activity.progressive and post.get('completed'):
+		activity.progress()
+	activity.setvalues(profile)
+	return activity
+
+
+def get_field_values(instance):
+	"""Returns dict of model instance's field values, keyed by attname."""
+	return {
+		field.attname:getattr(instance,field.attname)
+		for field in instance._meta.concrete_fields
 		}
-	
-	# Check if usr has history, if not create
-	if profile.history:
-		history = json.loads(profile.history)	
-	else: 
-		history = []
-	# Check history length and trim oldest if necessary
-	if len(history) > 50:
-		history = history[:49]
-	# Add new entry to front of history
-	history.insert(0,historyentry)
-	profile.history = json.dumps(history)
-	return profile	
+
+
+def save_changed(instance,old_values):
+	"""
+	Saves only the fields of instance that differ from old_values (from
+	get_field_values). Returns list of saved field names.
+	"""
+	changed = [
+		name for name,value in get_field_values(instance).items()
+		if old_values[name] != value
+		]
+	if changed:
+		instance.save(update_fields=changed)
+	return changed
+
+
+def bulk_save_changed(changes):
+	"""
+	Saves the changed fields of several activities, given iterable of
+	(activity, old_values) pairs. Uses one bulk_update for Activity fields
+	and one for each activity subclass with changed fields of its own.
+	"""
+	parent_fields = {field.attname for field in Activity._meta.concrete_fields}
+	parent_changed = set()
+	activities = []
+	subclasses = {}
+	for activity,old_values in changes:
+		changed = {
+			name for name,value in get_field_values(activity).items()
+			if old_values[name] != value
+			}
+		parent_changed |= changed & parent_fields
+		activities.append(activity)
+		model_acts,model_changed = subclasses.setdefault(type(activity),([],set()))
+		model_acts.append(activity)
+		model_changed |= changed - parent_fields
+	if parent_changed:
+		Activity.objects.bulk_update(activities,sorted(parent_changed))
+	for model,(model_acts,model_changed) in subclasses.items():
+		if model_changed:
+			model.objects.bulk_update(model_acts,sorted(model_changed))
+
+
+def recompute_distances(profile):
+	"""
+	Re-estimates the distance of all of profile owner's time based runs from
+	their current pace settings. Only changed runs are written, with a single
+	bulk_update. Returns the number of runs updated.
+	"""
+	paces = profile.pace_table()
+	runs = PacedRun.objects.filter(
+		owner=profile.owner_id,
+		prog_value=PacedRun.PROG_CHOICES[0][0],
+		minutes__isnull=False,
+		).only('pace','minutes','distance')
+	changed = []
+	for run in runs:
+		# Runs saved with paces no longer in the table keep their distance.
+		if run.pace not in paces:
+			continue
+		distance = estimate_distance(paces[run.pace],run.minutes)
+		if run.distance != distance:
+			run.distance = distance
+			changed.append(run)
+	# Distance is an Activity column, so update that table directly.
+	Activity.objects.bulk_update(changed,['distance'])
+	if changed:
+		caching.invalidate_activities(profile.owner_id)
+	return len(changed)
+
+
+def update_mileage(user,date_done,act_distance=0):
+	"""
+	Add distance value to user's total for the week containing date_done.
+	date_done should be date object, act_distance should be decimal. The 
+	total is updated in the database, so concurrent submissions add up. 
+	"""
+	# If activity has no distance value, return to avoid creating empty rows
+	if not act_distance:
+		return
+	act_distance = Decimal(act_distance).quantize(Decimal('0.01'))
+	week_start = get_initial_date(date_done)
+	week = WeeklyMileage.objects.filter(owner=user,week_start=week_start)
+	if week.update(distance=F('distance') + act_distance):
+		return
+	# No row for this week yet, create it.
+	try:
+		with transaction.atomic():
+			WeeklyMileage.objects.create(
+				owner=user,
+				week_start=week_start,
+				distance=act_distance,
+				)
+	except IntegrityError:
+		# Row was created by a concurrent request since the update above.
+		week.update(distance=F('distance') + act_distance)
+
+
+def update_history(user,date_done,distance,name):
+	"""
+	Add entry to user's activity history and return it. date_done should be 
+	date object, distance should be decimal or None.
+	"""
+	return ActivityLog.objects.create(
+		owner=user,
+		date=date_done,
+		name=name,
+		distance=distance or None,
+		)
 
 
 def get_profile(user):
 	"""
 	Return profile object for user, if none found initialises one. 
-	If not logged in returns 0 .
+	If not logged in returns 0 . Views should use request.profile, which is
+	loaded with this function by ProfileMiddleware.
 	"""
 	if user.is_authenticated:
 		try:
-			profile = Profile.objects.get(owner=user)
-		except:
-			profile = Profile(owner=user)
-			profile.save()	
-		return profile
+			return user.profile
+		except Profile.DoesNotExist:
+			# Already looked for, so create without selecting again. There can
+			# only be one profile per user, so a concurrent request creating
+			# it first raises IntegrityError.
+			try:
+				with transaction.atomic():
+					profile = Profile.objects.create(owner=user)
+			except IntegrityError:
+				profile = Profile.objects.get(owner=user)
+			# Cached on user, so later reads of user.profile do not query.
+			user.profile = profile
+			return profile
 	else:
 		return 0	 
 
@@ -600,108 +1078,170 @@ def get_model(act_type):
 
 
 def get_act(act_id):
-	"""accepts an id number and returns the associated act, returns 0 if
-	activity does not exist"""
+	"""accepts an id number and returns the associated act as its concrete 
+	type, returns 0 if activity does not exist"""
 	try:
-		return Activity.objects.get(id=act_id)
+		return Activity.objects.select_subclasses().get(id=act_id)
 	except:
 		return 0	
 
 
+def get_user_act(user,act_id):
+	"""
+	Returns user's activity with given id as its concrete type, in one query.
+	Raises Http404 if activity does not exist or belongs to another user.
+	"""
+	activity = get_act(act_id)
+	if not activity or activity.owner_id != user.id:
+		raise Http404
+	return activity
+
+
+def get_act_map(user,act_ids,select_subclasses=False):
+	"""
+	Accepts a user and an iterable of activity id values (as submitted in
+	forms), returns dict mapping id strings to the user's activities in one query. 
+	'REST' and any other non-id values are ignored. If select_subclasses is
+	True, activities are loaded as their concrete types.
+	"""
+	ids = {int(act_id) for act_id in act_ids if str(act_id).isdigit()}
+	if not ids:
+		return {}
+	activities = Activity.objects.filter(owner=user,id__in=ids)
+	if select_subclasses:
+		activities = activities.select_subclasses()
+	return {str(activity.id):activity for activity in activities}
+
+
 class Day:
 	"""
 	For constructing schedule list used on home page. Home screen schedule
-	is built from a list of these objects.
+	is built from a list of these objects. Today's date can be given to save
+	looking it up for every day.
 	"""
-	def __init__(self,day_date,name=rest_string):
-		self.date_str = day_date.strftime(dateFormat)
-		if day_date == date.today():
+	__slots__ = (
+		'date_str',
+		'name',
+		'complete',
+		'past',
+		'act_id',
+		'date_iso',
+		'day_date',
+		'link',
+		)
+
+	def __init__(self,day_date,name=rest_string,today=None):
+		if day_date == (today or date.today()):
 			self.date_str = 'Today'
+		else:
+			# Same as day_date.strftime(dateFormat), without strftime.
+			self.date_str = (f'{DAY_NAMES[day_date.weekday()]} '
+				f'{day_date.day:02d} {MONTH_NAMES[day_date.month]}')
 		self.name = name
 		self.complete = False
 		self.past = False
 		self.act_id = 0
 		self.date_iso = day_date.isoformat()
+		self.day_date = day_date
 		self.link = False
 
 
+def get_schedule_position(plan_start_date,today,plan_length):
+	"""
+	Returns (date of Monday starting current schedule, current plan week), 
+	given date user's plan started, today's date and plan length in weeks.
+	Plan week counts from 0.
+	"""
+	start_date = get_initial_date(today)
+	weeks = (start_date - get_initial_date(plan_start_date)).days // 7
+	return start_date,weeks % plan_length
+
+
+def set_plan_start(profile):
+	"""
+	Saves start date of profile's plan as the current week if it does not have
+	one yet. The profile row is locked while checking, so concurrent requests
+	agree on a single date. Returns the plan start date.
+	"""
+	with transaction.atomic():
+		locked = (Profile.objects.select_for_update()
+			.only('plan_start_date').get(pk=profile.pk))
+		if not locked.plan_start_date:
+			locked.plan_start_date = get_initial_date(date.today())
+			locked.save(update_fields=['plan_start_date'])
+	profile.plan_start_date = locked.plan_start_date
+	return profile.plan_start_date
+
+
+def get_cached_schedule_list(profile):
+	"""
+	Returns schedule list for profile from the cache, building and caching it
+	if it is not there.
+	"""
+	with phase('schedule_cache'):
+		key = caching.schedule_key(profile)
+		schedule_list = caching.get_schedule(key)
+	if schedule_list is None:
+		schedule_list = get_schedule_list(profile)
+		caching.set_schedule(key,schedule_list)
+	return schedule_list
+
+
 def get_schedule_list(profile,replace=True):
 	"""
 	Creates a list of 14 'day' objects, based on user's plan. Used on home
-	screen to display two week schedule.
+	screen to display two week schedule. Returns an empty list if user has
+	no plan.
 	if replace=True, will check schedule against completed activities, if any
 	dates overlap the scheduled activity will be replaced with the completed
 	activity.
 	"""
-	# Check how many days have passed since the initial date of current schedule
-	if not profile.schedule_init_date:
-		profile.schedule_init_date = get_initial_date(date.today())
-	date_diff = date.today() - profile.schedule_init_date
-	if date_diff.days >= 7:
-		# At least one week has passed, reset schedule initial date.
-		profile.schedule_week += 1
-		profile.schedule_init_date = get_initial_date(date.today())
-		if profile.schedule_week >= profile.plan_length:
-			# Passed end of plan, reset to week 0
-			profile.schedule_week = 0 
-		profile.save()
-	# Load user's activity pattern 'plan'.
-	plan = json.loads(profile.plan)
-	# Create empty schedule list with correct dates, names all 'rest' 
-	sch_list = []
-	start_date = profile.schedule_init_date
-	for i in range(14):
-		day = Day(start_date+timedelta(days=i),rest_string)
-		sch_list.append(day)	
-	# Plan_days = List of integers, represents which days from user's plan will 
-	# be used to create current schedule instance.
-	plan_days = [1,2,3,4,5,6,7,1,2,3,4,5,6,7]
-	# 1 Week plan will always use this 14-day schedule format,longer plans 
-	# will vary depending on which week of schedule user is on.
-	a = [1,2,3,4,5,6,7]
-	b = [8,9,10,11,12,13,14]
-	c = [15,16,17,18,19,20,21]
-	d = [22,23,24,25,26,27,28]
-	if profile.plan_length != 1:
-		week = profile.schedule_week
-		# Combine number lists to make correct list of plan days, according to
-		# plan length anc current week
-		if week == 0:
-			plan_days = a + b
-		if week == 1:
-			if profile.plan_length == 2: 
-				plan_days = b + a
-			if profile.plan_length == 4:
-				plan_days = b + c
-		if week == 2:
-			plan_days = c + d
-		if week == 3:
-			plan_days = d + a		 	
-	# Create schedule list object, copying plan activities to correct position
-	# in schedule.
-	for i in range(14):
-		day_value = plan[f'day_{plan_days[i]}']
-		if day_value != 'REST':
-			activity = get_act(day_value)
-			if activity:
-				sch_list[i].name = activity.name
-				sch_list[i].act_id = day_value
+	# Work out where in the plan today falls. Nothing is saved, so building 
+	# the schedule never writes to the database.
+	today = date.today()
+	start_date,week = get_schedule_position(
+		profile.plan_start_date or today,
+		today,
+		profile.plan_length,
+		)
+	# Plan_days = which days from user's plan will be used to create current
+	# schedule instance, according to plan length and current week.
+	plan_days = PLAN_DAYS.get((profile.plan_length,week),PLAN_DAYS[(1,0)])
+	with phase('schedule_plan'):
+		# Load the plan slots for those days with their activities in one query.
+		slots = {
+			slot.day_index:slot for slot in 
+			PlanSlot.objects.filter(profile=profile.pk,day_index__in=plan_days)
+			.select_related('activity')
+			}
+		if not slots:
+			return []
+		# Create empty schedule list with correct dates, names all 'rest' 
+		sch_list = [
+			Day(start_date+timedelta(days=i),rest_string,today) for i in range(14)]
+		# Copy plan activities to correct position in schedule.
+		for i in range(14):
+			slot = slots.get(plan_days[i])
+			if slot and slot.activity:
+				sch_list[i].name = slot.activity.name
+				sch_list[i].act_id = slot.activity_id
 	if replace == True:
-		# Look up user's completed activities
-		past_acts = CompletedAct.objects.filter(owner=profile.owner)
-		
-		for day in sch_list:
-			for past_act in past_acts:
-				if day.date_str == past_act.date_done.strftime(dateFormat):
+		with phase('schedule_overlay'):
+			# Look up user's completed activities in the schedule window, indexed
+			# by date so each day is a single dict lookup.
+			end_date = start_date + timedelta(days=13)
+			past_acts = CompletedAct.objects.filter(
+				owner=profile.owner_id,
+				date_done__range=(start_date,end_date),
+				)
+			done_dict = {past_act.date_done:past_act for past_act in past_acts}
+			for day in sch_list:
+				past_act = done_dict.get(day.day_date)
+				if past_act:
 					day.name = past_act.name
 					day.complete = True
-			if day.date_str == 'Today':
-				for past_act in past_acts:
-					if past_act.date_done == date.today():
-						day.name = past_act.name
-						day.complete = True		
-				# If 'today' has activity and is not complete, 
-				# set its link attr True.
-				if not day.complete and (day.name != rest_string):
-					day.link = True
+				# If 'today' has activity and is not complete, set its link attr True.
+				if day.day_date == today:
+					if not day.complete and (day.name != rest_string):
+						day.link = True
 	return sch_list
\ No newline at end of file
@@ -5,6 +5,15 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
+
+Serves the sync views like the WSGI application. Setting the ASYNC_VIEWS
+environment variable to TRUE serves async versions of the home, history and
+mileage views instead. On SQLite they were slower than the sync views (see
+the bench_async command), so compare them on the production database before
+turning them on. To deploy with ASGI, use this Procfile line in place of the
+WSGI one:
+
+web: gunicorn runproj2.asgi:application -k uvicorn.workers.UvicornWorker --log-file -
 """
 
 import os
@@ -43,12 +43,20 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
 ]
 
+# The planner middleware is sync only, so under ASGI the stack runs in one
+# thread per request. Were it async, Django's own middleware would run each of
+# its hooks in another thread, which made every view slower.
 MIDDLEWARE = [
+    'planner.middleware.MetricsMiddleware',
+    'planner.middleware.TimingMiddleware',
+    'planner.middleware.QueryBudgetMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'planner.middleware.ProfileMiddleware',
+    'planner.middleware.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -57,7 +65,8 @@ ROOT_URLCONF = 'runproj2.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # Django templates, with rendering time reported by TimingMiddleware.
+        'BACKEND': 'planner.instrumentation.TimedDjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -128,9 +137,13 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # My settings
 LOGIN_URL = 'users:login'
+# Load session user and their planner profile with one query.
+PROFILE_SELECT_USER = True
 
 # heroku settings
 import os
+import sys
+import tempfile
 import django_heroku
 django_heroku.settings(locals())
 
@@ -138,4 +151,84 @@ if os.environ.get('DEBUG') == 'TRUE':
     DEBUG = True
 elif os.environ.get('DEBUG') == 'FALSE':
     DEBUG = False
-        
\ No newline at end of file
+
+# Cache used for home page schedules and fragments. Their per-user versions
+# must be seen by every gunicorn worker, so outside debug mode the cache is
+# shared: Redis if REDIS_URL is set (needs the redis package), otherwise files
+# in CACHE_DIR (shared by the workers on one machine). Local memory is kept
+# by each worker separately, so it is only used in debug mode, with a single
+# worker.
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        }
+    }
+elif os.environ.get('CACHE_DIR') or not DEBUG:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.environ.get(
+                'CACHE_DIR', os.path.join(tempfile.gettempdir(), 'kanplan-cache')),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'kanplan',
+        }
+    }
+        
+
+# Per request timing, see planner.middleware.TimingMiddleware. Fraction of
+# requests timed, and whether timings are logged as well as sent in the
+# Server-Timing header. Logged by default when not in debug mode.
+TIMING_SAMPLE_RATE = float(os.environ.get('TIMING_SAMPLE_RATE', '1'))
+TIMING_LOG = os.environ.get('TIMING_LOG', str(not DEBUG).upper()) == 'TRUE'
+LOGGING.setdefault('formatters', {})['message'] = {'format': '%(message)s'}
+LOGGING.setdefault('handlers', {})['timing'] = {
+    'class': 'logging.StreamHandler',
+    'formatter': 'message',
+}
+LOGGING.setdefault('loggers', {})['planner.timing'] = {
+    'handlers': ['timing'],
+    'level': 'INFO',
+    'propagate': False,
+}
+
+# Query budgets for views, see planner.middleware.QueryBudgetMiddleware. Most
+# queries by view name, overriding budgets set with @query_budget, and whether
+# going over budget raises, logs or only counts. Logs in debug mode, set
+# QUERY_BUDGET_MODE=raise to fail instead, e.g. when running tests.
+QUERY_BUDGETS = {}
+QUERY_BUDGET_MODE = os.environ.get(
+    'QUERY_BUDGET_MODE', 'log' if DEBUG else 'count')
+
+# Request metrics, see planner.metrics. Each worker process writes its
+# metrics to a file in METRICS_DIR every METRICS_FLUSH_SECONDS (0 to only
+# write when scraped, as when running tests), /metrics adds them up. Files not
+# written for METRICS_STALE_SECONDS, of workers which have exited, are
+# removed. Scrapes must send METRICS_TOKEN as a bearer token or be by a staff
+# user, unless in debug mode without a token set.
+METRICS_DIR = os.environ.get(
+    'METRICS_DIR', os.path.join(tempfile.gettempdir(), 'planner-metrics'))
+METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', '5'))
+if sys.argv[1:2] == ['test']:
+    METRICS_FLUSH_SECONDS = 0
+METRICS_STALE_SECONDS = float(os.environ.get('METRICS_STALE_SECONDS', '300'))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Request profiling, see planner.profiling. Fraction of requests profiled,
+# header staff users can send to profile a request, where profiles are saved
+# and how many are kept.
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_HEADER = 'X-Profile'
+PROFILE_DIR = os.environ.get(
+    'PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'planner-profiles'))
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', '50'))
+
+# Serve async versions of the home, history and mileage views, only of use
+# when served by an ASGI server (runproj2/asgi.py). Off unless set to TRUE.
+ASYNC_VIEWS = os.environ.get('ASYNC_VIEWS', 'FALSE') == 'TRUE'